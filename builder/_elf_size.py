@@ -0,0 +1,410 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Program size of the ESP8266 memory regions, read from the ELF section
+headers without running $SIZETOOL, and the per-symbol memory map.
+"""
+
+import bisect
+import collections
+import json
+import re
+import struct
+import sys
+from os.path import basename, isfile, relpath, splitext
+
+from SCons.Script import ARGUMENTS, Import
+
+Import("env")
+
+SHT_NOBITS = 8
+SHF_ALLOC = 0x2
+STT_OBJECT = 1
+STT_FUNC = 2
+
+# https://github.com/esp8266/esp8266-wiki/wiki/Memory-Map
+MEMORY_REGIONS = (
+    ("dram", 0x3FFE8000, 0x40000000),
+    ("iram", 0x40100000, 0x40110000),
+    ("flash", 0x40200000, 0x40300000),
+)
+
+# the cache takes the rest of the 64K unless the core is built with
+# a different MMU_IRAM_SIZE
+DEFAULT_IRAM_SIZE = 0x8000
+
+ElfSection = collections.namedtuple(
+    "ElfSection", "name type flags addr offset size")
+ElfSymbol = collections.namedtuple("ElfSymbol", "name addr size type section")
+
+
+def read_elf(path, symbols=False):
+    """Returns the sections and, if asked for, the sized symbols"""
+    with open(path, "rb") as fp:
+        ident = fp.read(64)
+        if ident[:4] != b"\x7fELF":
+            raise ValueError("%s is not an ELF file" % path)
+        endian = "<" if ident[5] == 1 else ">"
+        if ident[4] == 2:
+            shoff = struct.unpack_from(endian + "Q", ident, 0x28)[0]
+            shentsize, shnum, shstrndx = struct.unpack_from(
+                endian + "HHH", ident, 0x3A)
+            header = struct.Struct(endian + "IIQQQQ")
+            entry = struct.Struct(endian + "IBBHQQ")
+        else:
+            shoff = struct.unpack_from(endian + "I", ident, 0x20)[0]
+            shentsize, shnum, shstrndx = struct.unpack_from(
+                endian + "HHH", ident, 0x2E)
+            header = struct.Struct(endian + "IIIIII")
+            entry = struct.Struct(endian + "IIIBBH")
+        fp.seek(shoff)
+        table = fp.read(shentsize * shnum)
+        # name, type, flags, addr, offset, size
+        headers = [
+            header.unpack_from(table, i * shentsize) for i in range(shnum)
+        ]
+        fp.seek(headers[shstrndx][4])
+        names = fp.read(headers[shstrndx][5])
+        sections = [
+            ElfSection(_get_string(names, h[0]), *h[1:]) for h in headers
+        ]
+        if not symbols:
+            return sections, []
+
+        tables = dict((s.name, s) for s in sections if s.name in (
+            ".symtab", ".strtab"))
+        if len(tables) != 2:
+            return sections, []
+        fp.seek(tables[".symtab"].offset)
+        symtab = fp.read(tables[".symtab"].size)
+        fp.seek(tables[".strtab"].offset)
+        strtab = fp.read(tables[".strtab"].size)
+
+    result = []
+    for fields in entry.iter_unpack(symtab):
+        if ident[4] == 2:
+            name, info, _, shndx, value, size = fields
+        else:
+            name, value, size, info, _, shndx = fields
+        type_ = info & 0xF
+        if size and type_ in (STT_OBJECT, STT_FUNC) and shndx < len(sections):
+            result.append(ElfSymbol(
+                _get_string(strtab, name), value, size, type_,
+                sections[shndx].name))
+    return sections, result
+
+
+def _get_string(table, offset):
+    return table[offset:table.index(b"\0", offset)].decode("utf-8", "replace")
+
+
+def get_region(addr):
+    for name, start, end in MEMORY_REGIONS:
+        if start <= addr < end:
+            return name
+    return None
+
+
+def _is_loaded(section):
+    return section.flags & SHF_ALLOC and section.size
+
+
+def get_iram_size(env):
+    for define in env.get("CPPDEFINES", []):
+        if isinstance(define, (list, tuple)) and define[0] == "MMU_IRAM_SIZE":
+            return int(str(define[1]), 0)
+    return DEFAULT_IRAM_SIZE
+
+
+def GetProgramSizes(env, elf_path):
+    board = env.BoardConfig()
+    sections = []
+    used = dict(iram=0, dram=0, flash=0)
+    program_size = 0
+    for section in read_elf(elf_path)[0]:
+        region = get_region(section.addr)
+        if not _is_loaded(section) or region is None:
+            continue
+        sections.append(dict(
+            name=section.name, address=section.addr, size=section.size,
+            region=region))
+        used[region] += section.size
+        # .bss takes no room in the image
+        if section.type != SHT_NOBITS:
+            program_size += section.size
+
+    ram_max = int(board.get("upload.maximum_ram_size", 0))
+    return dict(
+        sections=sections,
+        iram=dict(used=used["iram"], max=get_iram_size(env)),
+        dram=dict(used=used["dram"], max=ram_max),
+        flash=dict(used=used["flash"]),
+        program=dict(
+            used=program_size,
+            max=int(board.get("upload.maximum_size", 0))),
+        heap_free=max(ram_max - used["dram"], 0) if ram_max else None,
+    )
+
+
+def _format_available_bytes(value, total):
+    percent_raw = float(value) / float(total)
+    blocks_per_progress = 10
+    used_blocks = min(
+        int(round(blocks_per_progress * percent_raw)), blocks_per_progress)
+    return "[{:{}}] {: 6.1%} (used {:d} bytes from {:d} bytes)".format(
+        "=" * used_blocks, blocks_per_progress, percent_raw, value, total)
+
+
+def _get_elf_path(env, source):
+    if source:
+        return str(source[0])
+    return env.subst("$BUILD_DIR/${PROGNAME}.elf")
+
+
+def _write_sizes(elf_path, sizes):
+    with open(splitext(elf_path)[0] + ".size.json", "w") as fp:
+        json.dump(sizes, fp, indent=2)
+
+
+def CheckUploadSize(_, target, source, env):  # pylint: disable=unused-argument
+    elf_path = _get_elf_path(env, source)
+    sizes = env.GetProgramSizes(elf_path)
+    _write_sizes(elf_path, sizes)
+
+    iram, dram, program = sizes["iram"], sizes["dram"], sizes["program"]
+    # the RAM and Flash lines of PlatformIO, tools parse them
+    if dram["max"]:
+        print("RAM:   %s" % _format_available_bytes(dram["used"], dram["max"]))
+    if program["max"]:
+        print("Flash: %s" % _format_available_bytes(
+            program["used"], program["max"]))
+    print("IRAM:  %s" % _format_available_bytes(iram["used"], iram["max"]))
+    if dram["max"]:
+        print("Free heap estimate: %d bytes" % sizes["heap_free"])
+    if int(ARGUMENTS.get("PIOVERBOSE", 0)):
+        env.PrintProgramSizes(elf_path, sizes)
+
+    if iram["used"] > iram["max"]:
+        sys.stderr.write(
+            "Warning! The IRAM size (%d bytes) is greater than maximum "
+            "allowed (%d bytes)\n" % (iram["used"], iram["max"]))
+    if dram["max"] and dram["used"] > dram["max"]:
+        sys.stderr.write(
+            "Warning! The data size (%d bytes) is greater than maximum "
+            "allowed (%d bytes)\n" % (dram["used"], dram["max"]))
+    if program["max"] and program["used"] > program["max"]:
+        sys.stderr.write(
+            "Error: The program size (%d bytes) is greater than maximum "
+            "allowed (%d bytes)\n" % (program["used"], program["max"]))
+        env.Exit(1)
+
+    env.CheckSizeHistory(sizes)
+
+
+def PrintProgramSizes(env, elf_path, sizes=None):
+    if sizes is None:
+        sizes = env.GetProgramSizes(elf_path)
+        _write_sizes(elf_path, sizes)
+    print("%-24s %10s %12s  %s" % ("section", "size", "addr", "region"))
+    for section in sizes["sections"]:
+        print("%-24s %10d %#12x  %s" % (
+            section["name"], section["size"], section["address"],
+            section["region"]))
+    print("%-24s %10d" % ("Total IRAM", sizes["iram"]["used"]))
+    print("%-24s %10d" % ("Total DRAM", sizes["dram"]["used"]))
+    print("%-24s %10d" % ("Total flash code", sizes["flash"]["used"]))
+    print("%-24s %10d" % ("Total image", sizes["program"]["used"]))
+
+
+#
+# Memory map
+#
+
+# input section lines after "Linker script and memory map" of a GNU ld map,
+# the address columns are on the next line when the name is too long
+MAP_SECTION_RE = re.compile(
+    r"^ (\.\S+)(?:\s+0x([\da-f]+)\s+0x([\da-f]+)\s+(\S.*))?$")
+MAP_CONTINUATION_RE = re.compile(r"^\s+0x([\da-f]+)\s+0x([\da-f]+)\s+(\S.*)$")
+ARCHIVE_MEMBER_RE = re.compile(r"^(.+\.a)\((.+)\)$")
+
+# sections of ICACHE_RAM_ATTR/IRAM_ATTR functions
+IRAM_ATTR_SECTIONS = (".iram.text", ".iram0.text", ".iram1")
+
+
+def read_linker_map(map_path):
+    """Returns the input sections as sorted (addr, size, section, object)"""
+    result = []
+    with open(map_path) as fp:
+        for line in fp:
+            if line.startswith("Linker script and memory map"):
+                break
+        name = None
+        for line in fp:
+            match = MAP_SECTION_RE.match(line)
+            if match:
+                name = match.group(1)
+                if not match.group(2):
+                    continue
+                addr, size, source = match.group(2, 3, 4)
+            else:
+                match = MAP_CONTINUATION_RE.match(line)
+                if not match or name is None:
+                    name = None
+                    continue
+                addr, size, source = match.groups()
+            addr, size = int(addr, 16), int(size, 16)
+            if addr and size:
+                result.append((addr, size, name, source.strip()))
+            name = None
+    result.sort()
+    return result
+
+
+def _split_source(env, source):
+    """(library, object) of a map source, paths made relative to the build"""
+    match = ARCHIVE_MEMBER_RE.match(source)
+    if match:
+        return basename(match.group(1)), match.group(2)
+    try:
+        return "", relpath(source, env.subst("$BUILD_DIR"))
+    except ValueError:
+        return "", source
+
+
+def _format_source(library, obj):
+    return "%s(%s)" % (library, obj) if library else obj
+
+
+def _get_group(section_name, region):
+    return "IRAM" if region == "iram" else section_name
+
+
+def _top(counter, limit):
+    return [
+        dict(name=name, size=size) for name, size in counter.most_common(limit)
+    ]
+
+
+def AnalyzeMemoryMap(env, elf_path, map_path=None, limit=20):
+    sections, symbols = read_elf(elf_path, symbols=True)
+    input_sections = []
+    if map_path and isfile(map_path):
+        input_sections = read_linker_map(map_path)
+    starts = [s[0] for s in input_sections]
+
+    def find_input_section(addr):
+        i = bisect.bisect_right(starts, addr) - 1
+        if i >= 0 and addr < input_sections[i][0] + input_sections[i][1]:
+            return input_sections[i]
+        return None
+
+    groups = collections.OrderedDict()
+    loaded = sorted(
+        (s for s in sections if _is_loaded(s) and get_region(s.addr)),
+        key=lambda s: s.addr)
+    loaded_starts = [s.addr for s in loaded]
+    for section in loaded:
+        group = groups.setdefault(
+            _get_group(section.name, get_region(section.addr)),
+            dict(size=0, symbols=collections.Counter(),
+                 objects=collections.Counter(),
+                 libraries=collections.Counter()))
+        group["size"] += section.size
+
+    iram_attr = []
+    seen = set()
+    for symbol in symbols:
+        region = get_region(symbol.addr)
+        if region is None or (symbol.addr, symbol.name) in seen:
+            continue
+        seen.add((symbol.addr, symbol.name))
+        group = groups.get(_get_group(symbol.section, region))
+        if group is None:
+            continue
+        source = find_input_section(symbol.addr)
+        label = symbol.name
+        if source:
+            label += "  " + _format_source(*_split_source(env, source[3]))
+        group["symbols"][label] += symbol.size
+        if region == "iram" and symbol.type == STT_FUNC and (
+                source is None or source[2].startswith(IRAM_ATTR_SECTIONS)):
+            iram_attr.append(dict(name=label, size=symbol.size))
+
+    # the map attributes every byte, unnamed data and string literals too
+    strings = collections.Counter()
+    for addr, size, name, source in input_sections:
+        i = bisect.bisect_right(loaded_starts, addr) - 1
+        if i < 0 or addr >= loaded[i].addr + loaded[i].size:
+            continue
+        region = get_region(addr)
+        group = groups[_get_group(loaded[i].name, region)]
+        library, obj = _split_source(env, source)
+        group["objects"][_format_source(library, obj)] += size
+        group["libraries"][library or "(project)"] += size
+        if name.startswith(".rodata.str") and region == "dram":
+            strings[_format_source(library, obj)] += size
+
+    result = collections.OrderedDict()
+    for name, group in groups.items():
+        named = sum(group["symbols"].values())
+        result[name] = dict(
+            size=group["size"],
+            unnamed=max(group["size"] - named, 0),
+            symbols=_top(group["symbols"], limit),
+            objects=_top(group["objects"], limit),
+            libraries=_top(group["libraries"], limit),
+        )
+    iram_attr.sort(key=lambda item: item["size"], reverse=True)
+    return dict(
+        regions=result,
+        iram_attr=iram_attr,
+        rodata_strings=_top(strings, limit),
+    )
+
+
+def PrintMemoryMap(env, elf_path, map_path=None):
+    data = env.AnalyzeMemoryMap(elf_path, map_path)
+    with open(splitext(elf_path)[0] + ".memmap.json", "w") as fp:
+        json.dump(data, fp, indent=2)
+
+    for name, region in data["regions"].items():
+        print("")
+        print("%s: %d bytes, %d not covered by symbols" % (
+            name, region["size"], region["unnamed"]))
+        for title in ("symbols", "objects", "libraries"):
+            if not region[title]:
+                continue
+            print("  top %s:" % title)
+            for item in region[title]:
+                print("    %8d  %s" % (item["size"], item["name"]))
+
+    if data["iram_attr"]:
+        print("")
+        print("ICACHE_RAM_ATTR functions (%d bytes):" % sum(
+            item["size"] for item in data["iram_attr"]))
+        for item in data["iram_attr"]:
+            print("    %8d  %s" % (item["size"], item["name"]))
+    if data["rodata_strings"]:
+        print("")
+        print("String literals in DRAM, candidates for F()/PSTR():")
+        for item in data["rodata_strings"]:
+            print("    %8d  %s" % (item["size"], item["name"]))
+
+
+env.AddMethod(GetProgramSizes)
+env.AddMethod(CheckUploadSize)
+env.AddMethod(PrintProgramSizes)
+env.AddMethod(AnalyzeMemoryMap)
+env.AddMethod(PrintMemoryMap)
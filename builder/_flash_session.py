@@ -0,0 +1,371 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Flash writes through esptool running in-process. Regions the device already
+has, by the MD5 of its flash, are skipped, the others are sent as sector
+deltas against the record of what was last flashed to the chip:
+
+    board_build.upload_skip_identical = yes
+    board_build.upload_delta = yes    ; implies upload_skip_identical
+
+The records are kept per chip MAC and are trusted only after the device
+confirmed their MD5. Images are written as they are, the flash size in the
+header at 0x0 is the one the image was built with. Of the `upload_flags`,
+--before, --after and --baud apply, the others are ignored with a warning.
+"""
+
+import hashlib
+import shlex
+import sys
+import time
+import zlib
+from os.path import join
+
+from SCons.Script import Import
+
+Import("env")
+
+SECTOR_SIZE = 0x1000
+RECORDS_VERSION = 1
+
+# a compressed block expands to up to 64K of erased and written flash
+WRITE_BLOCK_TIMEOUT = 30
+
+# tried from the top when the fastest working rate is asked for
+FLASH_BAUDS = (921600, 460800, 230400, 115200)
+
+# upload_flags of esptool.py the in-process session takes over
+SESSION_FLAGS = {
+    "--before": "before",
+    "--after": "after",
+    "-b": "baud",
+    "--baud": "baud",
+}
+
+
+def import_esptool(env):
+    path = env.PioPlatform().get_package_dir("tool-esptoolpy") or ""
+    if path and path not in sys.path:
+        sys.path.insert(0, path)
+    import esptool  # pylint: disable=import-outside-toplevel
+    return esptool
+
+
+def _get_rom_class(esptool):
+    if hasattr(esptool, "ESP8266ROM"):
+        return esptool.ESP8266ROM
+    # esptool 4.x
+    from esptool.targets import ESP8266ROM  # noqa pylint: disable=all
+    return ESP8266ROM
+
+
+class FlashSession(object):
+
+    def __init__(self, esptool, port, baud, before, after, flash_size):
+        self.esptool = esptool
+        self.port = port
+        self.baud = baud
+        self.before = before
+        self.after = after
+        self.flash_size = flash_size
+        self.esp = None
+        self.mac = None
+        self.written = False
+        self.bytes_sent = 0
+
+    def open(self, bauds=()):
+        """Connects at the highest of `baud` and `bauds` that works"""
+        rom = _get_rom_class(self.esptool)
+        if self.before != "default_reset":
+            # without a reset the loader keeps the rate of the failed try
+            bauds = ()
+        bauds = sorted(set(bauds) | set([self.baud]), reverse=True)
+        for baud in bauds:
+            esp = rom(self.port, rom.ESP_ROM_BAUD)
+            try:
+                esp.connect(self.before)
+                esp = esp.run_stub()
+                if baud > rom.ESP_ROM_BAUD:
+                    esp.change_baud(baud)
+                    # some adapters accept the rate and lose the data
+                    esp.flash_id()
+            except (self.esptool.FatalError, OSError):
+                esp._port.close()  # pylint: disable=protected-access
+                if baud == bauds[-1]:
+                    raise
+                print("No answer at %d baud, trying a lower rate" % baud)
+                continue
+            self.baud = baud
+            break
+        esp.flash_set_parameters(self.flash_size)
+        self.esp = esp
+        self.mac = "-".join("%02x" % b for b in esp.read_mac())
+        print("Connected to %s at %d baud" % (self.mac, self.baud))
+
+    def md5(self, address, size):
+        return self.esp.flash_md5sum(address, size)
+
+    def write(self, address, data):
+        compressed = zlib.compress(data, 9)
+        block_size = self.esp.FLASH_WRITE_SIZE
+        self.esp.flash_defl_begin(len(data), len(compressed), address)
+        for seq, offset in enumerate(range(0, len(compressed), block_size)):
+            self.esp.flash_defl_block(
+                compressed[offset:offset + block_size], seq,
+                timeout=WRITE_BLOCK_TIMEOUT)
+        self.written = True
+        self.bytes_sent += len(compressed)
+
+    def close(self):
+        if self.esp is None:
+            return
+        try:
+            if self.written:
+                # the stub stays in the loader, user code runs on reset
+                self.esp.flash_begin(0, 0)
+                self.esp.flash_defl_finish(False)
+            if self.after == "hard_reset":
+                self.esp.hard_reset()
+            elif self.after == "soft_reset":
+                self.esp.soft_reset(False)
+        finally:
+            self.esp._port.close()  # pylint: disable=protected-access
+            self.esp = None
+
+
+def get_sector_hashes(data):
+    return [
+        hashlib.md5(data[offset:offset + SECTOR_SIZE]).hexdigest()
+        for offset in range(0, len(data), SECTOR_SIZE)
+    ]
+
+
+def get_changed_ranges(old_hashes, new_hashes):
+    """Byte ranges of the runs of changed sectors"""
+    ranges = []
+    for index, digest in enumerate(new_hashes):
+        if index < len(old_hashes) and old_hashes[index] == digest:
+            continue
+        start = index * SECTOR_SIZE
+        if ranges and ranges[-1][1] == start:
+            ranges[-1] = (ranges[-1][0], start + SECTOR_SIZE)
+        else:
+            ranges.append((start, start + SECTOR_SIZE))
+    return ranges
+
+
+def _get_records_path(env, mac):
+    return join(
+        env.subst("$PROJECT_WORKSPACE_DIR"), "flash_records", mac + ".json")
+
+
+def _load_records(path):
+    data = env.ReadJson(path)
+    if not isinstance(data, dict) or data.get("version") != RECORDS_VERSION:
+        return {}
+    return data.get("regions", {})
+
+
+def _save_records(path, regions):
+    env.WriteJson(path, dict(version=RECORDS_VERSION, regions=regions))
+
+
+def write_region(session, records, address, data, delta=True, skip=True):
+    """Writes the sectors of `data` the device does not have yet"""
+    key = "0x%x" % address
+    md5 = hashlib.md5(data).hexdigest()
+    sectors = get_sector_hashes(data)
+    record = records.pop(key, None)
+    device_md5 = session.md5(address, len(data)) if skip or delta else None
+    if skip and device_md5 == md5:
+        records[key] = dict(size=len(data), md5=md5, sectors=sectors)
+        print("Flash at %s: identical, skipped" % key)
+        return True
+
+    ranges = None
+    if delta and record and record["size"] == len(data):
+        if device_md5 == record["md5"]:
+            ranges = get_changed_ranges(record["sectors"], sectors)
+        else:
+            print("Flash at %s of %s differs from its record, writing all "
+                  "of it" % (key, session.mac))
+    if ranges is None:
+        ranges = [(0, len(data))]
+
+    sent = session.bytes_sent
+    for start, end in ranges:
+        session.write(address + start, data[start:end])
+    if session.md5(address, len(data)) != md5:
+        sys.stderr.write(
+            "Error: Flash at %s of %s does not match the image after the "
+            "write\n" % (key, session.mac))
+        return False
+    records[key] = dict(size=len(data), md5=md5, sectors=sectors)
+    print("Flash at %s: wrote %d of %d sectors, %d bytes sent" % (
+        key, sum(-(-(end - start) // SECTOR_SIZE) for start, end in ranges),
+        len(sectors), session.bytes_sent - sent))
+    return True
+
+
+def IsUploadDeltaEnabled(env):
+    return env.IsBoardOptionEnabled("upload_delta")
+
+
+def IsUploadSkipEnabled(env):
+    return env.IsBoardOptionEnabled(
+        "upload_skip_identical") or env.IsUploadDeltaEnabled()
+
+
+def bench_region(session, records, address, data):
+    """Times the delta write of `data` against a full write of it"""
+    started = time.time()
+    sent = session.bytes_sent
+    if not write_region(session, records, address, data, delta=True):
+        return None
+    delta = (session.bytes_sent - sent, time.time() - started)
+
+    started = time.time()
+    sent = session.bytes_sent
+    session.write(address, data)
+    # write_flash of esptool verifies the MD5 as well
+    if session.md5(address, len(data)) != hashlib.md5(data).hexdigest():
+        return None
+    full = (session.bytes_sent - sent, time.time() - started)
+    return dict(address=address, size=len(data), delta=delta, full=full)
+
+
+def _get_session_options(env, before, after):
+    """Reset methods and baud rate with those of upload_flags applied"""
+    options = dict(before=before, after=after,
+                   baud=int(env.subst("$UPLOAD_SPEED") or 115200))
+    ignored = []
+    flags = shlex.split(env.subst(" ".join(env.get("UPLOAD_FLAGS", []))))
+    index = 0
+    while index < len(flags):
+        start = index
+        name, sep, value = flags[index].partition("=")
+        option = SESSION_FLAGS.get(name)
+        if option and not sep and index + 1 < len(flags):
+            index += 1
+            value = flags[index]
+        if option == "baud" and value.isdigit():
+            options[option] = int(value)
+        elif option in ("before", "after") and value:
+            options[option] = value
+        else:
+            ignored.extend(flags[start:index + 1])
+        index += 1
+    if ignored:
+        sys.stderr.write(
+            "Warning! The in-process upload ignores the upload_flags %s\n" %
+            " ".join(ignored))
+    return options
+
+
+def _run_session(env, before, after, flash_size, callback, bauds=()):
+    """Calls `callback(session, records)` in one esptool session"""
+    try:
+        esptool = import_esptool(env)
+    except ImportError:
+        sys.stderr.write(
+            "Error: esptool is not found, please install `tool-esptoolpy`\n")
+        return 1
+
+    options = _get_session_options(env, before, after)
+    session = FlashSession(
+        esptool, env.subst("$UPLOAD_PORT").strip('"'), options["baud"],
+        options["before"], options["after"], flash_size)
+    try:
+        session.open(bauds)
+        records_path = _get_records_path(env, session.mac)
+        records = _load_records(records_path)
+        try:
+            if not callback(session, records):
+                return 1
+        finally:
+            # regions left out of the records are written in full next time
+            _save_records(records_path, records)
+        session.close()
+    except (esptool.FatalError, OSError) as e:
+        sys.stderr.write("Error: %s\n" % e)
+        return 1
+    finally:
+        if session.esp is not None:
+            session.esp._port.close()  # pylint: disable=protected-access
+    return 0
+
+
+def _read_regions(regions):
+    for address, path in regions:
+        with open(path, "rb") as fp:
+            yield int(address), fp.read()
+
+
+def WriteFlashRegions(env, regions, before, after, flash_size, delta=True,
+                      skip=True, fastest_baud=False):
+    """Writes [(address, image path)] in one session, returns 0 on success"""
+    started = time.time()
+
+    def _write(session, records):
+        return all(
+            write_region(session, records, address, data, delta, skip)
+            for address, data in _read_regions(regions))
+
+    code = _run_session(
+        env, before, after, flash_size, _write,
+        FLASH_BAUDS if fastest_baud else ())
+    if not code:
+        print("Flashed %d regions in %.1fs" % (
+            len(regions), time.time() - started))
+    return code
+
+
+def BenchFlashRegions(env, regions, before, after, flash_size):
+    """Reports bytes sent and time of delta writes against full writes"""
+    results = []
+
+    def _bench(session, records):
+        for address, data in _read_regions(regions):
+            result = bench_region(session, records, address, data)
+            if result is None:
+                sys.stderr.write(
+                    "Error: Flash at 0x%x does not match the image\n" %
+                    address)
+                return False
+            results.append(result)
+        return True
+
+    code = _run_session(env, before, after, flash_size, _bench)
+    if not results:
+        return code
+    print("%-10s %9s %11s %8s %11s %8s %8s" % (
+        "Region", "Size", "Delta sent", "Time", "Full sent", "Time",
+        "Speedup"))
+    rows = [("0x%x" % r["address"], r["size"], r["delta"], r["full"])
+            for r in results]
+    rows.append(("Total", sum(r[1] for r in rows),
+                 [sum(r[2][i] for r in rows) for i in (0, 1)],
+                 [sum(r[3][i] for r in rows) for i in (0, 1)]))
+    for name, size, delta, full in rows:
+        print("%-10s %9d %11d %7.2fs %11d %7.2fs %7.1fx" % (
+            name, size, delta[0], delta[1], full[0], full[1],
+            full[1] / max(delta[1], 0.001)))
+    return code
+
+
+env.AddMethod(IsUploadDeltaEnabled)
+env.AddMethod(IsUploadSkipEnabled)
+env.AddMethod(WriteFlashRegions)
+env.AddMethod(BenchFlashRegions)
@@ -0,0 +1,364 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Web assets of the data directory, minified and compressed into a staging
+directory the file system image is built from:
+
+    board_build.fs_assets = minify, gzip    ; or brotli
+
+A compressed asset replaces the original, e.g. index.html becomes
+index.html.gz, which ESP8266WebServer serves with Content-Encoding: gzip.
+Minifying only drops HTML and CSS comments, including those of <style>
+elements, indentation and blank lines. JavaScript keeps its comments, and
+the text of <pre> and <textarea> elements and of template literals is kept
+as it is.
+"""
+
+import concurrent.futures
+import gzip
+import hashlib
+import json
+import os
+import re
+import shutil
+import sys
+from os.path import dirname, isdir, isfile, join, relpath, splitext
+
+from SCons.Script import Import
+
+Import("env")
+
+# bump when the output for the same input and options changes
+ASSETS_CACHE_VERSION = 5
+
+MINIFIABLE = (".html", ".htm", ".css", ".js", ".json", ".svg")
+COMPRESSIBLE = MINIFIABLE + (".txt", ".xml", ".map", ".ico")
+
+# elements whitespace matters in, scripts have their template literals
+PRESERVED_HTML_RE = re.compile(
+    r"<(pre|textarea|script)\b.*?</\1\s*>", flags=re.I | re.S)
+# words a regular expression literal can follow
+REGEX_KEYWORDS = ("return", "typeof", "case", "do", "else", "in", "of", "new",
+                  "delete", "void", "throw", "yield", "await")
+STYLE_RE = re.compile(r"<style\b.*?</style\s*>", flags=re.I | re.S)
+
+
+def get_asset_options(env):
+    value = env.BoardConfig().get("build.fs_assets", "")
+    if isinstance(value, (list, tuple)):
+        value = ",".join(value)
+    options = [o.strip().lower() for o in re.split(r"[,\s]+", value)]
+    options = [o for o in options if o]
+    unknown = set(options) - set(["minify", "gzip", "brotli"])
+    if unknown:
+        sys.stderr.write(
+            "Warning! Unknown board_build.fs_assets options: %s\n" %
+            ", ".join(sorted(unknown)))
+    return [o for o in options if o not in unknown]
+
+
+def minify(ext, data):
+    if ext == ".json":
+        return json.dumps(
+            json.loads(data.decode("utf-8")), separators=(",", ":"),
+            ensure_ascii=False).encode("utf-8")
+    text = data.decode("utf-8")
+    if ext == ".css":
+        text = strip_css_comments(text)
+    elif ext in (".html", ".htm", ".svg"):
+        text = re.sub(r"<!--(?!\[if).*?-->", "", text, flags=re.S)
+        text = STYLE_RE.sub(lambda m: strip_css_comments(m.group(0)), text)
+    if ext == ".js":
+        text = _strip_js_lines(text)
+    elif ext in (".html", ".htm", ".svg"):
+        text = _strip_html_lines(text)
+    else:
+        text = _strip_lines(text)
+    return text.strip().encode("utf-8")
+
+
+def _skip_string(text, pos):
+    """Position after the quoted string starting at `pos`"""
+    quote = text[pos]
+    pos += 1
+    while pos < len(text) and text[pos] not in (quote, "\n"):
+        pos += 2 if text[pos] == "\\" else 1
+    return pos + 1
+
+
+def strip_css_comments(text):
+    """Drops the comments of CSS, skipping strings and unquoted URLs"""
+    result = []
+    start = pos = 0
+    while pos < len(text):
+        if text[pos] in "'\"":
+            pos = _skip_string(text, pos)
+        elif text[pos:pos + 4].lower() == "url(" and not re.match(
+                r"\s*['\"]", text[pos + 4:pos + 64]):
+            pos = text.find(")", pos)
+            pos = len(text) if pos < 0 else pos + 1
+        elif text.startswith("/*", pos):
+            result.append(text[start:pos])
+            end = text.find("*/", pos + 2)
+            start = pos = len(text) if end < 0 else end + 2
+        else:
+            pos += 1
+    result.append(text[start:])
+    return "".join(result)
+
+
+def _strip_lines(text):
+    """Drops indentation, trailing whitespace and blank lines"""
+    return re.sub(r"\s*\n\s*", "\n", text)
+
+
+def _strip_html_lines(text):
+    result = []
+    pos = 0
+    for match in PRESERVED_HTML_RE.finditer(text):
+        result.append(_strip_lines(text[pos:match.start()]))
+        block = match.group(0)
+        if match.group(1).lower() == "script":
+            start = block.index(">") + 1
+            end = block.lower().rindex("</script")
+            block = (block[:start] + _strip_js_lines(block[start:end]) +
+                     block[end:])
+        result.append(block)
+        pos = match.end()
+    result.append(_strip_lines(text[pos:]))
+    return "".join(result)
+
+
+def _strip_js_lines(text):
+    spans = find_template_literals(text)
+    if spans is None:
+        return text  # the scan lost track, better kept as it is
+    result = []
+    pos = 0
+    for start, end in spans:
+        result.append(_strip_lines(text[pos:start]))
+        result.append(text[start:end])
+        pos = end
+    result.append(_strip_lines(text[pos:]))
+    return "".join(result)
+
+
+def _is_regex_start(text, pos, last):
+    """Whether the `/` at `pos` starts a regular expression literal, `last`
+    is the code character before it"""
+    if last is None or last in "(,=:[!&|?{};+-*%<>~^":
+        return True
+    word = re.search(r"(\w+)\s*$", text[max(pos - 16, 0):pos])
+    return bool(word) and word.group(1) in REGEX_KEYWORDS
+
+
+def _skip_regex(text, pos):
+    """Position after the regular expression literal starting at `pos`"""
+    in_class = False
+    pos += 1
+    while pos < len(text) and text[pos] != "\n":
+        if text[pos] == "\\":
+            pos += 1
+        elif text[pos] == "[":
+            in_class = True
+        elif text[pos] == "]":
+            in_class = False
+        elif text[pos] == "/" and not in_class:
+            break
+        pos += 1
+    return pos + 1
+
+
+def find_template_literals(text):
+    """(start, end) of the outermost template literals of JavaScript code,
+    skipping strings, comments and regular expressions. None when the code
+    ends inside a template literal."""
+    spans = []
+    starts = []  # the template literals the scan is in
+    braces = []  # open braces of the ${} expressions the scan is in
+    last = None  # the last code character, tells a regex from a division
+    pos = 0
+    while pos < len(text):
+        char = text[pos]
+        if len(starts) > len(braces):  # text of a template literal
+            if char == "\\":
+                pos += 1
+            elif char == "`":
+                start = starts.pop()
+                if not starts:
+                    spans.append((start, pos + 1))
+                last = "`"
+            elif text.startswith("${", pos):
+                braces.append(0)
+                last = "{"
+                pos += 1
+            pos += 1
+            continue
+        if text.startswith("//", pos):
+            pos = text.find("\n", pos)
+            if pos < 0:
+                break
+        elif text.startswith("/*", pos):
+            pos = text.find("*/", pos + 2)
+            if pos < 0:
+                break
+            pos += 2
+            continue
+        elif char in "'\"":
+            pos = _skip_string(text, pos)
+            last = char
+            continue
+        elif char == "/" and _is_regex_start(text, pos, last):
+            pos = _skip_regex(text, pos)
+            last = "/"
+            continue
+        elif char == "`":
+            starts.append(pos)
+        elif braces and char == "{":
+            braces[-1] += 1
+        elif braces and char == "}":
+            if braces[-1]:
+                braces[-1] -= 1
+            else:
+                braces.pop()  # back in the text of the template literal
+        if not char.isspace():
+            last = char
+        pos += 1
+    if starts:
+        return None
+    return spans
+
+
+def compress(method, data):
+    if method == "brotli":
+        import brotli  # pylint: disable=import-outside-toplevel
+        return brotli.compress(data, quality=11), ".br"
+    # no timestamp, the same input gives the same image
+    return gzip.compress(data, 9, mtime=0), ".gz"
+
+
+def process_asset(path, options, cache_dir):
+    """Returns (cache key, output suffix, output data) of one file"""
+    with open(path, "rb") as fp:
+        data = fp.read()
+    ext = splitext(path)[1].lower()
+    key = hashlib.sha1(json.dumps(
+        [ASSETS_CACHE_VERSION, ext, options]).encode() + data).hexdigest()
+    cache_path = join(cache_dir, key)
+    if isfile(cache_path):
+        with open(cache_path, "rb") as fp:
+            suffix = fp.readline().decode().strip()
+            return key, suffix, fp.read()
+
+    suffix = ""
+    if "minify" in options and ext in MINIFIABLE:
+        try:
+            data = minify(ext, data)
+        except ValueError:
+            pass  # not UTF-8 or broken JSON, kept as is
+    method = "brotli" if "brotli" in options else (
+        "gzip" if "gzip" in options else None)
+    if method and ext in COMPRESSIBLE:
+        compressed, compressed_suffix = compress(method, data)
+        if len(compressed) < len(data):
+            data, suffix = compressed, compressed_suffix
+
+    env.WriteFileAtomic(cache_path, suffix.encode() + b"\n" + data)
+    return key, suffix, data
+
+
+def _write_if_changed(path, data):
+    if isfile(path) and os.path.getsize(path) == len(data):
+        with open(path, "rb") as fp:
+            if fp.read() == data:
+                return
+    if not isdir(dirname(path)):
+        os.makedirs(dirname(path))
+    with open(path, "wb") as fp:
+        fp.write(data)
+
+
+def PrepareFsAssets(env, data_dir):
+    """Returns the directory the file system image is built from"""
+    options = get_asset_options(env)
+    if not options:
+        return data_dir
+    if "brotli" in options:
+        try:
+            # pylint: disable=import-outside-toplevel,unused-import
+            import brotli  # noqa
+        except ImportError:
+            sys.stderr.write(
+                "Warning! Python package `brotli` is not installed, "
+                "using gzip\n")
+            options = [o for o in options if o != "brotli"] + ["gzip"]
+
+    staging_dir = env.subst(join("$BUILD_DIR", "fs_assets"))
+    cache_dir = env.subst(
+        join("$PROJECT_WORKSPACE_DIR", "fs_assets_cache", "$PIOENV"))
+    if not isdir(cache_dir):
+        os.makedirs(cache_dir)
+    paths = []
+    for root, dirs, names in os.walk(data_dir):
+        dirs.sort()
+        paths.extend(join(root, name) for name in sorted(names))
+
+    # only the compression runs in parallel, zlib and brotli release the GIL
+    # while minifying holds it. Threads still beat starting interpreters from
+    # within SCons for the few files of a data directory
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+        results = list(executor.map(
+            lambda path: process_asset(path, options, cache_dir), paths))
+
+    written = set()
+    total_before = total_after = 0
+    print("Preparing file system assets (%s)" % ", ".join(options))
+    for path, (_, suffix, data) in zip(paths, results):
+        name = relpath(path, data_dir) + suffix
+        _write_if_changed(join(staging_dir, name), data)
+        written.add(os.path.normpath(name))
+        before = os.path.getsize(path)
+        total_before += before
+        total_after += len(data)
+        if before != len(data):
+            print("  %-40s %8d -> %8d bytes (%+.1f%%)" % (
+                name, before, len(data),
+                100.0 * (len(data) - before) / before if before else 0))
+    print("  %-40s %8d -> %8d bytes, %d saved" % (
+        "Total", total_before, total_after, total_before - total_after))
+
+    # outputs of edited and removed files are not needed again
+    used = set(key for key, _, _ in results)
+    for name in os.listdir(cache_dir):
+        if name not in used:
+            try:
+                os.remove(join(cache_dir, name))
+            except OSError:
+                pass
+
+    # files removed from the data directory leave the image as well
+    for root, _, names in os.walk(staging_dir):
+        for name in names:
+            path = join(root, name)
+            if os.path.normpath(relpath(path, staging_dir)) not in written:
+                os.remove(path)
+    for root, dirs, _ in os.walk(staging_dir, topdown=False):
+        for name in dirs:
+            if not os.listdir(join(root, name)):
+                shutil.rmtree(join(root, name))
+    return staging_dir
+
+
+env.AddMethod(PrepareFsAssets)
@@ -0,0 +1,251 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Usage prediction of the file system image, checked before the image is
+built, and an in-process LittleFS image builder:
+
+    board_build.fs_builder = python    ; default is `tool`, mklittlefs
+
+The prediction is an estimate of the metadata. The build fails only when
+the data needs more than the image even with the least metadata possible,
+an estimate above the image size is a warning and the image builder has
+the last word.
+
+The in-process builder needs the `littlefs-python` package and builds
+LittleFS images only, SPIFFS images are always built by mkspiffs.
+"""
+
+import os
+import sys
+from os.path import join, relpath
+
+from SCons.Script import Import
+
+Import("env")
+
+# the configuration of LittleFS.h and spiffs_config.h of the Arduino core
+LFS_CACHE_SIZE = 64
+LFS_LOOKAHEAD_SIZE = 64
+LFS_NAME_MAX = 32
+LFS_DISK_VERSION = 0x00020000
+SPIFFS_OBJ_NAME_LEN = 32
+SPIFFS_PAGE_HEADER_SIZE = 5
+SPIFFS_OBJ_IX_HEADER_SIZE = 49
+SPIFFS_OBJ_IX_SIZE = 8
+SPIFFS_ID_SIZE = 2
+
+# LittleFS metadata: tags, the revision count and the commit CRCs
+LFS_TAG_SIZE = 4
+LFS_CTZ_STRUCT_SIZE = 8
+LFS_COMMIT_OVERHEAD = 36
+
+COPY_CHUNK_SIZE = 4096
+
+
+def _iter_data(data_dir):
+    """(relative path, size) of the directories (size None) and files"""
+    for root, dirs, names in os.walk(data_dir):
+        dirs.sort()
+        for name in dirs:
+            yield relpath(join(root, name), data_dir), None
+        for name in sorted(names):
+            path = join(root, name)
+            yield relpath(path, data_dir), os.path.getsize(path)
+
+
+def _ctz_blocks(size, block_size):
+    """Blocks of a LittleFS file stored as a CTZ skip-list"""
+    blocks = 0
+    while size > 0:
+        if blocks:
+            # block n starts with ctz(n) + 1 pointers to previous blocks
+            pointers = ((blocks & -blocks).bit_length() - 1) + 1
+            size -= block_size - pointers * 4
+        else:
+            size -= block_size
+        blocks += 1
+    return blocks
+
+
+def predict_littlefs(entries, block_size, block_count):
+    inline_max = min(LFS_CACHE_SIZE, block_size // 8)
+    pair_capacity = block_size // 2 - LFS_COMMIT_OVERHEAD
+    metadata = {"": 0}
+    data_blocks = 0
+    stored = 0
+    errors = []
+    for path, size in entries:
+        parent, name = os.path.split(path)
+        if len(name) > LFS_NAME_MAX:
+            errors.append("name is longer than %d characters: %s" % (
+                LFS_NAME_MAX, path))
+        entry = 2 * LFS_TAG_SIZE + len(name) + LFS_TAG_SIZE
+        if size is None:
+            metadata[path] = 0
+            entry += LFS_CTZ_STRUCT_SIZE
+        elif size <= inline_max:
+            entry += size
+        else:
+            entry += LFS_CTZ_STRUCT_SIZE
+            data_blocks += _ctz_blocks(size, block_size)
+        stored += size or 0
+        metadata[parent] = metadata.get(parent, 0) + entry
+
+    # a directory is a metadata pair, split in more pairs when it is full
+    metadata_blocks = sum(
+        2 * max(1, -(-size // pair_capacity)) for size in metadata.values())
+    used = metadata_blocks + data_blocks
+    return dict(
+        unit="blocks", unit_size=block_size, total=block_count, used=used,
+        # the data and the metadata pair of the root directory
+        minimum=data_blocks + 2,
+        free=(block_count - used) * block_size,
+        lost=used * block_size - stored, errors=errors)
+
+
+def predict_spiffs(entries, page_size, block_size, block_count):
+    pages_per_block = block_size // page_size
+    lookup_pages = -(-pages_per_block * SPIFFS_ID_SIZE // page_size)
+    usable = pages_per_block - lookup_pages
+    # the magic of the block takes the last entry of the lookup pages
+    if usable * SPIFFS_ID_SIZE > lookup_pages * page_size - SPIFFS_ID_SIZE:
+        usable -= 1
+    data_size = page_size - SPIFFS_PAGE_HEADER_SIZE
+    header_entries = (
+        page_size - SPIFFS_OBJ_IX_HEADER_SIZE) // SPIFFS_ID_SIZE
+    index_entries = (page_size - SPIFFS_OBJ_IX_SIZE) // SPIFFS_ID_SIZE
+
+    used = 0
+    stored = 0
+    errors = []
+    for path, size in entries:
+        if size is None:
+            continue  # SPIFFS is flat, directories are part of the names
+        name = "/" + path.replace(os.sep, "/")
+        if len(name) >= SPIFFS_OBJ_NAME_LEN:
+            errors.append("name is longer than %d characters: %s" % (
+                SPIFFS_OBJ_NAME_LEN - 1, name))
+        data_pages = -(-size // data_size)
+        index_pages = 1 + -(-max(0, data_pages - header_entries) //
+                            index_entries)
+        used += data_pages + index_pages
+        stored += size
+
+    total = block_count * usable
+    return dict(
+        unit="pages", unit_size=page_size, total=total, used=used,
+        # every file needs its data pages and index pages
+        minimum=used,
+        free=(total - used) * page_size, lost=used * page_size - stored,
+        errors=errors)
+
+
+def PredictFsUsage(env, data_dir, filesystem):
+    block_size = env["FS_BLOCK"]
+    block_count = (env["FS_END"] - env["FS_START"]) // block_size
+    entries = list(_iter_data(data_dir))
+    if filesystem == "littlefs":
+        return predict_littlefs(entries, block_size, block_count)
+    return predict_spiffs(
+        entries, env["FS_PAGE"], block_size, block_count)
+
+
+def CheckFsUsage(env, data_dir, filesystem):
+    """Returns False when the data cannot fit into the image"""
+    usage = env.PredictFsUsage(data_dir, filesystem)
+    print("File system usage (%s, predicted): %d of %d %s, %d bytes free, "
+          "%d bytes lost to metadata and partly used %s" % (
+              filesystem, usage["used"], usage["total"], usage["unit"],
+              max(usage["free"], 0), usage["lost"], usage["unit"]))
+    for error in usage["errors"]:
+        sys.stderr.write("Error: File system %s\n" % error)
+    if usage["minimum"] > usage["total"]:
+        sys.stderr.write(
+            "Error: The data directory needs at least %d %s more than the %d "
+            "bytes of the file system image\n" % (
+                usage["minimum"] - usage["total"], usage["unit"],
+                usage["total"] * usage["unit_size"]))
+        return False
+    if usage["used"] > usage["total"]:
+        sys.stderr.write(
+            "Warning! The data directory probably needs %d %s more than the "
+            "%d bytes of the file system image\n" % (
+                usage["used"] - usage["total"], usage["unit"],
+                usage["total"] * usage["unit_size"]))
+    return not usage["errors"]
+
+
+def GetFsBuilder(env, filesystem):
+    builder = env.BoardConfig().get("build.fs_builder", "tool")
+    if builder not in ("tool", "python"):
+        sys.stderr.write(
+            "Warning! Unknown board_build.fs_builder `%s`, using `tool`\n" %
+            builder)
+        return "tool"
+    if builder == "python" and filesystem != "littlefs":
+        sys.stderr.write(
+            "Warning! Only LittleFS images are built in-process, "
+            "using mk%s\n" % filesystem)
+        return "tool"
+    return builder
+
+
+def BuildLittleFSImage(env, data_dir, image_path):
+    """Streams the files into an image held in memory, returns 0 on success"""
+    try:
+        # pylint: disable=import-outside-toplevel
+        from littlefs import LittleFS, LittleFSError
+    except ImportError:
+        sys.stderr.write(
+            "Error: board_build.fs_builder = python needs the Python package "
+            "`littlefs-python`, install it with `pip install "
+            "littlefs-python`\n")
+        return 1
+
+    block_size = env["FS_BLOCK"]
+    fs = LittleFS(
+        mount=False, block_size=block_size,
+        block_count=(env["FS_END"] - env["FS_START"]) // block_size,
+        read_size=LFS_CACHE_SIZE, prog_size=LFS_CACHE_SIZE,
+        cache_size=LFS_CACHE_SIZE, lookahead_size=LFS_LOOKAHEAD_SIZE,
+        name_max=LFS_NAME_MAX, disk_version=LFS_DISK_VERSION)
+    try:
+        fs.format()
+        fs.mount()
+        for path, size in _iter_data(data_dir):
+            name = path.replace(os.sep, "/")
+            if size is None:
+                fs.mkdir(name)
+                continue
+            with open(join(data_dir, path), "rb") as src, \
+                    fs.open(name, "wb") as dst:
+                chunk = src.read(COPY_CHUNK_SIZE)
+                while chunk:
+                    dst.write(chunk)
+                    chunk = src.read(COPY_CHUNK_SIZE)
+        fs.unmount()
+    except LittleFSError as e:
+        sys.stderr.write("Error: Could not build the LittleFS image: %s\n" % e)
+        return 1
+
+    with open(image_path, "wb") as fp:
+        fp.write(fs.context.buffer)
+    return 0
+
+
+env.AddMethod(PredictFsUsage)
+env.AddMethod(CheckFsUsage)
+env.AddMethod(GetFsBuilder)
+env.AddMethod(BuildLittleFSImage)
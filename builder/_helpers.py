@@ -0,0 +1,73 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Helpers shared by the builder scripts, loaded before all of them.
+"""
+
+import json
+import os
+import sys
+import threading
+from os.path import dirname, isdir
+
+from SCons.Script import Import
+
+Import("env")
+
+_print_lock = threading.Lock()
+
+
+def IsBoardOptionEnabled(env, name, default="no"):
+    """Yes/no option `board_build.<name>`"""
+    value = str(env.BoardConfig().get("build." + name, default))
+    return value.lower() in ("1", "yes", "true")
+
+
+def PrintLine(env, message):
+    """Prints whole lines from the worker threads of uploads"""
+    with _print_lock:
+        print(message)
+        sys.stdout.flush()
+
+
+def WriteFileAtomic(env, path, data):
+    """Replaces the file at once, parallel builds and threads may write
+    the same file"""
+    if not isdir(dirname(path)):
+        os.makedirs(dirname(path), exist_ok=True)
+    tmp_path = "%s.%d.%d.tmp" % (path, os.getpid(), threading.get_ident())
+    with open(tmp_path, "wb" if isinstance(data, bytes) else "w") as fp:
+        fp.write(data)
+    os.replace(tmp_path, path)
+
+
+def ReadJson(env, path):
+    """Data of the JSON file, None if it is missing or broken"""
+    try:
+        with open(path) as fp:
+            return json.load(fp)
+    except (OSError, ValueError):
+        return None
+
+
+def WriteJson(env, path, data, indent=None):
+    env.WriteFileAtomic(path, json.dumps(data, indent=indent))
+
+
+env.AddMethod(IsBoardOptionEnabled)
+env.AddMethod(PrintLine)
+env.AddMethod(WriteFileAtomic)
+env.AddMethod(ReadJson)
+env.AddMethod(WriteJson)
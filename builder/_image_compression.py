@@ -0,0 +1,87 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Gzip copies of the firmware and file system images, `.bin.gz` next to the
+`.bin`. The updater of Arduino core 3.0 and newer unpacks gzip firmware, OTA
+uploads of the firmware send the compressed image then:
+
+    board_build.compress_images = yes
+
+The updater that unpacks the image is the one of the firmware running on
+the device, turn it on once the devices run core 3.0 or newer.
+"""
+
+import gzip
+import sys
+
+from SCons.Script import Import
+
+Import("env")
+
+SECTOR_SIZE = 0x1000
+
+
+def IsImageCompressionEnabled(env):
+    return env.IsBoardOptionEnabled("compress_images")
+
+
+def get_core_version(package_version):
+    """Arduino core version of a framework package version, 3.XYYZZ.0 is
+    core X.YY.ZZ, e.g. 3.20704.0 is 2.7.4"""
+    code = int(str(package_version).split(".")[1])
+    return (code // 10000, code // 100 % 100, code % 100)
+
+
+def IsCompressedOtaSupported(env):
+    if not env.IsImageCompressionEnabled():
+        return False
+    if "arduino" not in env.get("PIOFRAMEWORK", []):
+        return False
+    try:
+        version = env.PioPlatform().get_package_version(
+            "framework-arduinoespressif8266")
+        return get_core_version(version) >= (3, 0, 0)
+    except (AttributeError, IndexError, TypeError, ValueError):
+        return False
+
+
+def CompressImage(env, path, firmware=True):
+    with open(path, "rb") as fp:
+        data = fp.read()
+    # no timestamp, the same image gives the same archive
+    compressed = gzip.compress(data, 9, mtime=0)
+    with open(path + ".gz", "wb") as fp:
+        fp.write(compressed)
+    print("Compressed %s: %d -> %d bytes (%.0f%% smaller)" % (
+        path, len(data), len(compressed),
+        100.0 * (len(data) - len(compressed)) / len(data) if data else 0))
+    if not firmware:
+        return 0
+
+    # the new image is written next to the running one of about the same
+    # size, in the rest of the application area
+    app_size = int(env.BoardConfig().get("upload.maximum_size", 0))
+    ota_space = (app_size - len(data)) // SECTOR_SIZE * SECTOR_SIZE
+    if app_size and len(compressed) > ota_space:
+        sys.stderr.write(
+            "Warning! The compressed firmware of %d bytes does not fit into "
+            "the %d bytes left for OTA updates next to the running firmware\n"
+            % (len(compressed), max(ota_space, 0)))
+    return 0
+
+
+env.AddMethod(IsImageCompressionEnabled)
+env.AddMethod(IsCompressedOtaSupported)
+env.AddMethod(CompressImage)
@@ -0,0 +1,134 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+The same upload to many serial ports at once, e.g. for a production jig:
+
+    board_build.upload_ports = /dev/ttyUSB*, /dev/ttyACM0
+    board_build.upload_jobs = 8
+    board_build.upload_retries = 2
+"""
+
+import concurrent.futures
+import glob
+import re
+import subprocess
+import sys
+import time
+
+from SCons.Script import Import
+
+Import("env")
+
+DEFAULT_JOBS = 8
+DEFAULT_RETRIES = 2
+PROGRESS_STEP = 10
+
+PROGRESS_RE = re.compile(r"\((\d+) ?%\)")
+
+def get_upload_ports(env):
+    """Ports of board_build.upload_ports with the patterns expanded"""
+    value = env.BoardConfig().get("build.upload_ports", "")
+    if isinstance(value, (list, tuple)):
+        value = ",".join(value)
+    ports = []
+    for item in re.split(r"[,\s]+", value):
+        if not item:
+            continue
+        matches = sorted(glob.glob(item)) if glob.has_magic(item) else [item]
+        ports.extend(port for port in matches if port not in ports)
+    return ports
+
+
+def IsMultiPortUpload(env):
+    return bool(env.BoardConfig().get("build.upload_ports", ""))
+
+
+def _run_upload(cmd, port):
+    """Runs the upload of one port, returns (exit code, last output)"""
+    proc = subprocess.Popen(
+        cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+        universal_newlines=True, errors="replace")
+    reported = -PROGRESS_STEP
+    tail = []
+    for line in proc.stdout:
+        line = line.rstrip()
+        if not line:
+            continue
+        match = PROGRESS_RE.search(line)
+        if not match:
+            tail = (tail + [line])[-5:]
+        elif int(match.group(1)) >= reported + PROGRESS_STEP:
+            reported = int(match.group(1))
+            env.PrintLine("[%s] %d %%" % (port, reported))
+    return proc.wait(), tail
+
+
+def _upload_port(cmd, port, retries):
+    started = time.time()
+    for attempt in range(1, retries + 2):
+        env.PrintLine("[%s] Uploading, attempt %d" % (port, attempt))
+        code, tail = _run_upload(cmd, port)
+        if code == 0:
+            env.PrintLine("[%s] Done" % port)
+            return dict(port=port, ok=True, attempts=attempt,
+                        seconds=time.time() - started)
+        for line in tail:
+            env.PrintLine("[%s] %s" % (port, line))
+    return dict(port=port, ok=False, attempts=retries + 1,
+                seconds=time.time() - started)
+
+
+def UploadToPorts(env, target, source):
+    """Runs $UPLOADCMD for every port, returns 0 when all of them passed"""
+    board = env.BoardConfig()
+    ports = get_upload_ports(env)
+    if not ports:
+        sys.stderr.write(
+            "Error: No port matches board_build.upload_ports = %s\n" %
+            board.get("build.upload_ports"))
+        return 1
+    jobs = max(int(board.get("build.upload_jobs", DEFAULT_JOBS)), 1)
+    retries = int(board.get("build.upload_retries", DEFAULT_RETRIES))
+    # every port gets the reset flags of the $UPLOADERFLAGS
+    commands = [
+        (port, env.Clone(UPLOAD_PORT=port).subst(
+            "$UPLOADCMD", target=target, source=source))
+        for port in ports
+    ]
+
+    print("Uploading %s to %d ports, %d at a time" % (
+        source[0], len(ports), jobs))
+    started = time.time()
+    with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+        results = list(executor.map(
+            lambda item: _upload_port(item[1], item[0], retries),
+            commands))
+
+    print("%-24s %-6s %8s %8s" % ("Port", "Result", "Attempts", "Time"))
+    for result in results:
+        print("%-24s %-6s %8d %7.1fs" % (
+            result["port"], "PASS" if result["ok"] else "FAIL",
+            result["attempts"], result["seconds"]))
+    failed = [r["port"] for r in results if not r["ok"]]
+    print("%d passed, %d failed in %.1fs" % (
+        len(results) - len(failed), len(failed), time.time() - started))
+    if failed:
+        sys.stderr.write("Error: Upload failed on %s\n" % ", ".join(failed))
+        return 1
+    return 0
+
+
+env.AddMethod(IsMultiPortUpload)
+env.AddMethod(UploadToPorts)
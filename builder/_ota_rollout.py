@@ -0,0 +1,330 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+OTA rollout of the image to the hosts of an inventory file, in parallel
+and in waves:
+
+    upload_protocol = espota
+    board_build.ota_inventory = hosts.txt    ; "host[:port]" per line
+    board_build.ota_waves = 1, 10%, 100%     ; hosts updated after a wave
+    board_build.ota_health_check = http://{host}/health
+    board_build.ota_jobs = 16
+    board_build.ota_retries = 3
+
+The espota protocol runs in-process and all transfers share the image read
+once. The state of the rollout is kept in the workspace, a rollout that was
+stopped resumes with the hosts that are not updated yet. `espota_receiver.py`
+stands in for devices in tests.
+"""
+
+import concurrent.futures
+import hashlib
+import math
+import re
+import shlex
+import socket
+import sys
+import threading
+import time
+from os.path import basename, isfile, join
+from urllib.request import urlopen
+
+from SCons.Script import Import
+
+Import("env")
+
+# the commands of espota.py and ArduinoOTA
+OTA_FLASH = 0
+OTA_FS = 100
+OTA_AUTH = 200
+DEFAULT_OTA_PORT = 8266
+
+CHUNK_SIZE = 1460
+INVITATION_TRIES = 10
+SOCKET_TIMEOUT = 10
+# the device writes the last block and checks the MD5 before the OK
+RESULT_TIMEOUT = 60
+
+DEFAULT_JOBS = 16
+DEFAULT_RETRIES = 3
+DEFAULT_WAVES = "100%"
+BACKOFF_BASE = 2
+BACKOFF_MAX = 30
+HEALTH_CHECK_TIMEOUT = 90
+HEALTH_CHECK_INTERVAL = 3
+
+class OtaError(Exception):
+    pass
+
+
+def _md5(text):
+    return hashlib.md5(text.encode()).hexdigest()
+
+
+def send_image(host, port, image, image_md5, command, password=None,
+               name="firmware.bin"):
+    """Uploads `image` to the ArduinoOTA service of one device"""
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        server.bind(("", 0))
+        server.listen(1)
+        invitation = "%d %d %d %s\n" % (
+            command, server.getsockname()[1], len(image), image_md5)
+        udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        udp.settimeout(1)
+        try:
+            reply = None
+            for _ in range(INVITATION_TRIES):
+                udp.sendto(invitation.encode(), (host, port))
+                try:
+                    reply = udp.recv(37).decode()
+                    break
+                except socket.timeout:
+                    continue
+            if reply is None:
+                raise OtaError("no answer to the invitation")
+            if reply.startswith("AUTH"):
+                if not password:
+                    raise OtaError("the device asks for a password")
+                cnonce = _md5("%s%u%s%s" % (
+                    name, len(image), image_md5, host))
+                response = _md5("%s:%s:%s" % (
+                    _md5(password), reply.split()[1], cnonce))
+                udp.settimeout(SOCKET_TIMEOUT)
+                udp.sendto(("%d %s %s\n" % (
+                    OTA_AUTH, cnonce, response)).encode(), (host, port))
+                reply = udp.recv(32).decode()
+                if reply != "OK":
+                    raise OtaError("authentication failed")
+            elif reply != "OK":
+                raise OtaError("invitation refused: %s" % reply.strip())
+        finally:
+            udp.close()
+
+        server.settimeout(SOCKET_TIMEOUT)
+        try:
+            connection, _ = server.accept()
+        except socket.timeout:
+            raise OtaError("the device did not connect back")
+        try:
+            connection.settimeout(SOCKET_TIMEOUT)
+            data = memoryview(image)
+            acked = False
+            for offset in range(0, len(image), CHUNK_SIZE):
+                connection.sendall(data[offset:offset + CHUNK_SIZE])
+                acked = b"OK" in connection.recv(10)
+            if acked:
+                return
+            connection.settimeout(RESULT_TIMEOUT)
+            while True:
+                reply = connection.recv(32)
+                if not reply:
+                    raise OtaError("connection closed before the result")
+                if b"OK" in reply:
+                    return
+                if b"E" in reply:
+                    raise OtaError("the device reported an error")
+        finally:
+            connection.close()
+    except (OSError, socket.timeout) as e:
+        raise OtaError(str(e))
+    finally:
+        server.close()
+
+
+def read_inventory(path):
+    """(host, port) pairs of an inventory file"""
+    hosts = []
+    with open(path) as fp:
+        for line in fp:
+            line = line.split("#", 1)[0].strip()
+            if not line:
+                continue
+            host, _, port = line.split()[0].partition(":")
+            hosts.append((host, int(port) if port else None))
+    return hosts
+
+
+def split_waves(hosts, spec):
+    """Hosts of every wave, `spec` is the updated hosts after each wave"""
+    waves = []
+    done = 0
+    for item in re.split(r"[,\s]+", spec.strip()):
+        if not item:
+            continue
+        if item.endswith("%"):
+            limit = int(math.ceil(len(hosts) * float(item[:-1]) / 100))
+        else:
+            limit = int(item)
+        limit = min(max(limit, done), len(hosts))
+        if limit > done:
+            waves.append(hosts[done:limit])
+            done = limit
+    if done < len(hosts):
+        waves.append(hosts[done:])
+    return waves
+
+
+def check_health(url, timeout=HEALTH_CHECK_TIMEOUT):
+    """Waits until the rebooted device answers `url`"""
+    deadline = time.time() + timeout
+    while True:
+        try:
+            with urlopen(url, timeout=5) as response:
+                if 200 <= response.getcode() < 300:
+                    return True
+        except (OSError, ValueError):
+            pass
+        if time.time() > deadline:
+            return False
+        time.sleep(HEALTH_CHECK_INTERVAL)
+
+
+class RolloutState(object):
+    """Results per host, kept on disk after every change"""
+
+    def __init__(self, path, image_md5, command):
+        self.path = path
+        self.lock = threading.Lock()
+        self.data = dict(md5=image_md5, command=command, hosts={})
+        data = env.ReadJson(path)
+        if isinstance(data, dict) and data.get("md5") == image_md5 and \
+                data.get("command") == command:
+            self.data = data
+
+    def is_done(self, host):
+        return self.data["hosts"].get(host, {}).get("status") == "done"
+
+    def update(self, host, **values):
+        with self.lock:
+            self.data["hosts"].setdefault(host, {}).update(values)
+            env.WriteJson(self.path, self.data, indent=2)
+
+
+def _get_ota_flags(env):
+    """Device port and password of the espota.py upload_flags"""
+    port = DEFAULT_OTA_PORT
+    password = None
+    flags = shlex.split(env.subst(" ".join(env.get("UPLOAD_FLAGS", []))))
+    for index, flag in enumerate(flags):
+        name, _, value = flag.partition("=")
+        if not value and index + 1 < len(flags):
+            value = flags[index + 1]
+        if name in ("-p", "--port"):
+            port = int(value)
+        elif name in ("-a", "--auth"):
+            password = value
+    return port, password
+
+
+def _get_label(host, port):
+    return host if port == DEFAULT_OTA_PORT else "%s:%d" % (host, port)
+
+
+def _update_host(state, host, port, image, image_md5, command, password,
+                 name, retries):
+    label = _get_label(host, port)
+    started = time.time()
+    for attempt in range(1, retries + 2):
+        try:
+            send_image(host, port, image, image_md5, command, password, name)
+        except OtaError as e:
+            env.PrintLine("[%s] attempt %d failed: %s" % (label, attempt, e))
+            state.update(label, status="failed", attempts=attempt,
+                         error=str(e))
+            if attempt <= retries:
+                time.sleep(min(BACKOFF_BASE ** attempt, BACKOFF_MAX))
+            continue
+        env.PrintLine("[%s] updated in %.1fs" % (label, time.time() - started))
+        state.update(label, status="uploaded", attempts=attempt, error=None)
+        return True
+    return False
+
+
+def IsOtaRollout(env):
+    return bool(env.BoardConfig().get("build.ota_inventory", ""))
+
+
+def RolloutOta(env, image_path, fs=False):
+    """Uploads the image to the inventory, returns 0 when all hosts passed"""
+    board = env.BoardConfig()
+    inventory = join(
+        env.subst("$PROJECT_DIR"), board.get("build.ota_inventory"))
+    try:
+        hosts = read_inventory(inventory)
+    except (OSError, ValueError) as e:
+        sys.stderr.write("Error: Could not read the OTA inventory: %s\n" % e)
+        return 1
+    default_port, password = _get_ota_flags(env)
+    hosts = [(host, port or default_port) for host, port in hosts]
+    jobs = max(int(board.get("build.ota_jobs", DEFAULT_JOBS)), 1)
+    retries = int(board.get("build.ota_retries", DEFAULT_RETRIES))
+    health_url = board.get("build.ota_health_check", "")
+
+    if not fs and env.IsCompressedOtaSupported() and isfile(
+            image_path + ".gz"):
+        image_path += ".gz"
+    # read once, shared by all transfers
+    with open(image_path, "rb") as fp:
+        image = fp.read()
+    image_md5 = hashlib.md5(image).hexdigest()
+    command = OTA_FS if fs else OTA_FLASH
+    state = RolloutState(join(
+        env.subst("$PROJECT_WORKSPACE_DIR"), "ota_rollout",
+        env.subst("${PIOENV}.json")), image_md5, command)
+
+    pending = [h for h in hosts if not state.is_done(_get_label(*h))]
+    print("OTA rollout of %s (%s) to %d hosts, %d already updated" % (
+        basename(image_path), image_md5, len(hosts),
+        len(hosts) - len(pending)))
+
+    def _rollout_host(item):
+        host, port = item
+        label = _get_label(host, port)
+        if not _update_host(state, host, port, image, image_md5, command,
+                            password, basename(image_path), retries):
+            return False
+        # checked in the same job, the reboots of a wave are waited for at
+        # once
+        if health_url and not check_health(health_url.format(
+                host=host, port=port)):
+            env.PrintLine("[%s] health check failed" % label)
+            state.update(label, status="unhealthy")
+            return False
+        state.update(label, status="done")
+        return True
+
+    waves = split_waves(pending, board.get("build.ota_waves", DEFAULT_WAVES))
+    started = time.time()
+    for number, wave in enumerate(waves, 1):
+        print("Wave %d of %d: %d hosts" % (number, len(waves), len(wave)))
+        with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+            results = list(executor.map(_rollout_host, wave))
+
+        failed = [_get_label(*h) for h, ok in zip(wave, results) if not ok]
+        if failed:
+            sys.stderr.write(
+                "Error: Wave %d failed on %s, the rollout is stopped. Run "
+                "the upload again to resume it.\n" % (
+                    number, ", ".join(failed)))
+            return 1
+
+    print("OTA rollout finished, %d hosts updated in %.1fs" % (
+        len(pending), time.time() - started))
+    return 0
+
+
+env.AddMethod(IsOtaRollout)
+env.AddMethod(RolloutOta)
@@ -0,0 +1,166 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Size history of the environment and the growth limit against a baseline.
+
+    board_build.size_baseline = size_baseline.json
+    board_build.size_growth_limit = 2K    ; or 1%
+
+Without a baseline file the first recorded build is the baseline.
+`pio run -t sizebaseline` makes the last build the new baseline.
+"""
+
+import json
+import os
+import sys
+import time
+from os.path import dirname, isfile, join
+
+from SCons.Script import Import
+
+Import("env")
+
+# totals of GetProgramSizes() the growth limit applies to
+TRACKED_SIZES = ("program", "iram", "dram")
+
+
+def _get_history_path(env):
+    return join(
+        env.subst("$PROJECT_WORKSPACE_DIR"), "size_history",
+        env.subst("${PIOENV}.jsonl"))
+
+
+def _get_baseline_path(env):
+    path = env.BoardConfig().get("build.size_baseline", "")
+    if path:
+        return join(env.subst("$PROJECT_DIR"), path)
+    return join(
+        env.subst("$PROJECT_WORKSPACE_DIR"), "size_history",
+        env.subst("${PIOENV}.baseline.json"))
+
+
+def _make_record(sizes):
+    record = dict(time=time.strftime("%Y-%m-%dT%H:%M:%S"))
+    for name in TRACKED_SIZES:
+        record[name] = sizes[name]["used"]
+    record["flash"] = sizes["flash"]["used"]
+    record["sections"] = dict(
+        (s["name"], s["size"]) for s in sizes["sections"])
+    return record
+
+
+def _read_last_record(path):
+    if not isfile(path):
+        return None
+    with open(path, "rb") as fp:
+        # records are small, the tail of a long history is enough
+        fp.seek(max(os.path.getsize(path) - 65536, 0))
+        lines = fp.read().decode("utf-8", "replace").splitlines()
+    for line in reversed(lines):
+        try:
+            return json.loads(line)
+        except ValueError:
+            continue
+    return None
+
+
+def _parse_growth_limit(value, base):
+    """Bytes of growth allowed, `value` is "1024", "2K" or "1.5%" """
+    value = str(value).strip()
+    if not value:
+        return None
+    if value.endswith("%"):
+        return int(base * float(value[:-1]) / 100)
+    if value[-1].upper() in ("K", "M"):
+        scale = 1024 if value[-1].upper() == "K" else 1024 * 1024
+        return int(float(value[:-1]) * scale)
+    return int(value, 0)
+
+
+def _is_same_build(record, other):
+    return other is not None and all(
+        record[k] == other.get(k) for k in TRACKED_SIZES + ("sections", ))
+
+
+def _print_deltas(record, baseline):
+    deltas = []
+    for name in TRACKED_SIZES + ("flash", ):
+        delta = record[name] - baseline.get(name, 0)
+        if delta:
+            deltas.append("%s %+d" % (name, delta))
+    if not deltas:
+        return
+    print("Size against baseline of %s: %s" % (
+        baseline.get("time", "?"), ", ".join(deltas)))
+    sections = baseline.get("sections", {})
+    for name in sorted(set(sections) | set(record["sections"])):
+        delta = record["sections"].get(name, 0) - sections.get(name, 0)
+        if delta:
+            print("  %-24s %+10d" % (name, delta))
+
+
+def CheckSizeHistory(env, sizes):
+    record = _make_record(sizes)
+    history_path = _get_history_path(env)
+    # checkprogsize runs on every build, even when nothing was relinked
+    if not _is_same_build(record, _read_last_record(history_path)):
+        if not os.path.isdir(dirname(history_path)):
+            os.makedirs(dirname(history_path))
+        with open(history_path, "a") as fp:
+            fp.write(json.dumps(record) + "\n")
+
+    baseline_path = _get_baseline_path(env)
+    baseline = env.ReadJson(baseline_path)
+    if baseline is None:
+        env.WriteJson(baseline_path, record, indent=2)
+        return
+    _print_deltas(record, baseline)
+
+    limit = env.BoardConfig().get("build.size_growth_limit", "")
+    failed = False
+    for name in TRACKED_SIZES:
+        try:
+            allowed = _parse_growth_limit(limit, baseline.get(name, 0))
+        except ValueError:
+            sys.stderr.write(
+                "Error: Invalid board_build.size_growth_limit `%s`, use "
+                "bytes, e.g. `1024` or `2K`, or a percentage, e.g. `1.5%%`\n"
+                % limit)
+            env.Exit(1)
+        growth = record[name] - baseline.get(name, 0)
+        if allowed is not None and growth > allowed:
+            sys.stderr.write(
+                "Error: The %s size grew by %d bytes against the baseline, "
+                "more than the allowed %d bytes (board_build.size_growth_limit"
+                " = %s)\n" % (name, growth, allowed, limit))
+            failed = True
+    if failed:
+        sys.stderr.write(
+            "Run `pio run -t sizebaseline` to accept the new size.\n")
+        env.Exit(1)
+
+
+def UpdateSizeBaseline(env):
+    record = _read_last_record(_get_history_path(env))
+    if record is None:
+        sys.stderr.write("Error: There is no recorded build, build first.\n")
+        env.Exit(1)
+    env.WriteJson(_get_baseline_path(env), record, indent=2)
+    print("Size baseline of %s set to the build of %s" % (
+        env.subst("$PIOENV"), record["time"]))
+
+
+env.AddMethod(CheckSizeHistory)
+env.AddMethod(UpdateSizeBaseline)
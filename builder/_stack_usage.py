@@ -0,0 +1,234 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Worst-case stack depth of the entry points, from the .su and .ci files
+GCC writes next to the objects with -fstack-usage and -fcallgraph-info:
+
+    board_build.stack_usage = yes
+    board_build.stack_budget = 4096
+    board_build.stack_entry_points = my_task, my_timer_cb
+"""
+
+import json
+import os
+import re
+import sys
+from os.path import join
+
+from SCons.Script import Import
+
+Import("env")
+
+# the cont stack of the Arduino core
+DEFAULT_STACK_BUDGET = 4096
+
+DEFAULT_ENTRY_POINTS = (
+    "_Z5setupv", "_Z4loopv", "setup", "loop", "user_init", "app_main")
+
+# entry points reported besides the configured ones
+MAX_ROOTS = 10
+
+INDIRECT_CALL = "__indirect_call"
+UNKNOWN_NOTE = "no stack info: "
+
+CI_NODE_RE = re.compile(r'^node: \{ title: "([^"]+)" label: "([^"]*)"(.*)\}')
+CI_EDGE_RE = re.compile(r'^edge: \{ sourcename: "([^"]+)" targetname: "([^"]+)"')
+STACK_USAGE_RE = re.compile(r"\\n(\d+) bytes \(([a-z,]+)\)")
+SU_LINE_RE = re.compile(r"^(.+):\d+:\d+:(.+)\t(\d+)\t([a-z,]+)$")
+
+
+def is_stack_usage_enabled(env):
+    return env.IsBoardOptionEnabled("stack_usage")
+
+
+def _has_callgraph_info(env):
+    # -fcallgraph-info comes with GCC 10, toolchain-xtensa 2.x
+    try:
+        version = env.PioPlatform().get_package_version("toolchain-xtensa")
+        return int(str(version).split(".")[0]) >= 2
+    except (AttributeError, TypeError, ValueError):
+        return False
+
+
+def ConfigureStackUsage(env):
+    """Called by the framework scripts once their flags are in place"""
+    if not is_stack_usage_enabled(env):
+        return
+    flags = ["-fstack-usage"]
+    if _has_callgraph_info(env):
+        flags.append("-fcallgraph-info=su")
+    env.Append(CCFLAGS=flags)
+    env.AddPostAction(
+        join("$BUILD_DIR", "${PROGNAME}.elf"),
+        env.VerboseAction(
+            lambda source, target, env: env.PrintStackUsage(
+                only_over_budget=True),
+            "Checking stack usage"))
+
+
+def _iter_build_files(build_dir, suffix):
+    for root, _, files in os.walk(build_dir):
+        for name in files:
+            if name.endswith(suffix):
+                yield join(root, name)
+
+
+def read_call_graph(build_dir):
+    """Returns functions as {name: (label, stack usage, kind)} and calls"""
+    functions = {}
+    calls = {}
+    for path in _iter_build_files(build_dir, ".ci"):
+        with open(path) as fp:
+            for line in fp:
+                match = CI_NODE_RE.match(line)
+                if match:
+                    usage = STACK_USAGE_RE.search(match.group(2))
+                    if usage:
+                        label = match.group(2).split("\\n", 1)[0]
+                        functions[match.group(1)] = (
+                            label, int(usage.group(1)), usage.group(2))
+                    continue
+                match = CI_EDGE_RE.match(line)
+                if match:
+                    calls.setdefault(match.group(1), set()).add(match.group(2))
+    if functions:
+        return functions, calls
+
+    # an older toolchain, frames without the call graph
+    for path in _iter_build_files(build_dir, ".su"):
+        with open(path) as fp:
+            for line in fp:
+                match = SU_LINE_RE.match(line.rstrip("\n"))
+                if match:
+                    source, label, usage, kind = match.groups()
+                    functions["%s:%s" % (source, label)] = (
+                        label, int(usage), kind)
+    return functions, calls
+
+
+class StackAnalyzer(object):
+
+    def __init__(self, functions, calls):
+        self.functions = functions
+        self.calls = calls
+        self._worst = {}
+
+    def get_roots(self):
+        called = set()
+        for callees in self.calls.values():
+            called.update(callees)
+        return [name for name in self.functions if name not in called]
+
+    def worst(self, name, active=None):
+        """(depth, path, notes) of the deepest call chain from `name`"""
+        if name in self._worst:
+            return self._worst[name]
+        active = active or set()
+        if name == INDIRECT_CALL:
+            return 0, [], set(["indirect calls not followed"])
+        if name not in self.functions:
+            return 0, [], set([UNKNOWN_NOTE + name])
+        if name in active:
+            return 0, [], set(["recursion in %s" % self.functions[name][0]])
+
+        label, usage, kind = self.functions[name]
+        notes = set()
+        if kind != "static":
+            notes.add("%s has a %s frame" % (label, kind))
+        deepest = (0, [])
+        active.add(name)
+        for callee in sorted(self.calls.get(name, ())):
+            depth, path, callee_notes = self.worst(callee, active)
+            notes.update(callee_notes)
+            if depth > deepest[0]:
+                deepest = (depth, path)
+        active.discard(name)
+
+        result = (
+            usage + deepest[0], [(label, usage)] + deepest[1], notes)
+        # results below a recursion depend on where the cycle was entered
+        if not any(note.startswith("recursion") for note in notes):
+            self._worst[name] = result
+        return result
+
+
+def AnalyzeStackUsage(env):
+    board = env.BoardConfig()
+    budget = int(board.get("build.stack_budget", DEFAULT_STACK_BUDGET))
+    functions, calls = read_call_graph(env.subst("$BUILD_DIR"))
+    analyzer = StackAnalyzer(functions, calls)
+
+    names = list(DEFAULT_ENTRY_POINTS)
+    names.extend(
+        name.strip()
+        for name in str(board.get("build.stack_entry_points", "")).split(",")
+        if name.strip())
+    entries = [name for name in names if name in functions]
+    if calls:
+        roots = sorted(
+            (name for name in analyzer.get_roots() if name not in entries),
+            key=lambda name: analyzer.worst(name)[0], reverse=True)
+        entries.extend(roots[:MAX_ROOTS])
+    else:
+        # no call graph, the largest frames are all there is to report
+        entries = sorted(
+            functions, key=lambda name: functions[name][1],
+            reverse=True)[:MAX_ROOTS]
+
+    result = []
+    for name in entries:
+        depth, path, notes = analyzer.worst(name)
+        # library functions built without the flags are counted as 0 bytes
+        unknown = sorted(
+            note[len(UNKNOWN_NOTE):] for note in notes
+            if note.startswith(UNKNOWN_NOTE))
+        notes = sorted(n for n in notes if not n.startswith(UNKNOWN_NOTE))
+        if unknown:
+            notes.append(UNKNOWN_NOTE + ", ".join(unknown))
+        result.append(dict(
+            entry=functions[name][0], depth=depth, over_budget=depth > budget,
+            path=[dict(function=f, frame=size) for f, size in path],
+            notes=notes))
+    return dict(budget=budget, call_graph=bool(calls), entries=result)
+
+
+def PrintStackUsage(env, only_over_budget=False):
+    data = env.AnalyzeStackUsage()
+    with open(env.subst(join("$BUILD_DIR", "${PROGNAME}.stack.json")),
+              "w") as fp:
+        json.dump(data, fp, indent=2)
+
+    if not data["call_graph"]:
+        print("Stack usage: no call graph (-fcallgraph-info needs "
+              "toolchain-xtensa 2.x), showing the largest frames")
+    over_budget = [e for e in data["entries"] if e["over_budget"]]
+    for entry in (over_budget if only_over_budget else data["entries"]):
+        print("%-40s %6d bytes%s" % (
+            entry["entry"], entry["depth"],
+            "  OVER BUDGET" if entry["over_budget"] else ""))
+        if entry["over_budget"] or not only_over_budget:
+            print("    " + " -> ".join(
+                "%s (%d)" % (f["function"], f["frame"]) for f in entry["path"]))
+        for note in entry["notes"]:
+            print("    note: %s" % note)
+    if over_budget:
+        sys.stderr.write(
+            "Warning! %d entry points may use more than %d bytes of stack "
+            "(board_build.stack_budget)\n" % (len(over_budget), data["budget"]))
+
+
+env.AddMethod(ConfigureStackUsage)
+env.AddMethod(AnalyzeStackUsage)
+env.AddMethod(PrintStackUsage)
@@ -0,0 +1,147 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Stand-in for the ArduinoOTA service of devices, to try OTA rollouts
+without a fleet:
+
+    python espota_receiver.py --ports 8266-8281 --auth secret
+
+and an inventory with the lines 127.0.0.1:8266 ... 127.0.0.1:8281.
+"""
+
+import argparse
+import hashlib
+import os
+import random
+import socket
+import threading
+
+
+def _md5(text):
+    return hashlib.md5(text.encode()).hexdigest()
+
+
+class Receiver(threading.Thread):
+
+    def __init__(self, port, password=None, failures=0, output_dir=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.port = port
+        self.password = password
+        self.failures = failures
+        self.output_dir = output_dir
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(("", port))
+
+    def log(self, message):
+        print("[%d] %s" % (self.port, message))
+
+    def run(self):
+        while True:
+            data, sender = self.sock.recvfrom(128)
+            try:
+                command, port, size, md5 = data.decode().split()
+            except ValueError:
+                continue
+            if self.failures > 0:
+                # a busy or rebooting device, the invitation is lost
+                self.failures -= 1
+                self.log("dropped the invitation")
+                continue
+            if self.password and not self.authenticate(sender, size, md5):
+                continue
+            self.sock.sendto(b"OK", sender)
+            try:
+                self.receive(
+                    sender[0], int(port), int(command), int(size), md5)
+            except OSError as e:
+                self.log("transfer failed: %s" % e)
+
+    def authenticate(self, sender, size, md5):
+        nonce = _md5(str(random.random()))
+        self.sock.sendto(("AUTH %s" % nonce).encode(), sender)
+        self.sock.settimeout(10)
+        try:
+            data, _ = self.sock.recvfrom(128)
+        except socket.timeout:
+            return False
+        finally:
+            self.sock.settimeout(None)
+        _, cnonce, response = data.decode().split()
+        expected = _md5("%s:%s:%s" % (_md5(self.password), nonce, cnonce))
+        if response != expected:
+            self.log("authentication failed")
+            self.sock.sendto(b"Authentication Failed", sender)
+            return False
+        return True
+
+    def receive(self, host, port, command, size, md5):
+        connection = socket.create_connection((host, port), timeout=10)
+        image = bytearray()
+        try:
+            while len(image) < size:
+                chunk = connection.recv(4096)
+                if not chunk:
+                    break
+                image.extend(chunk)
+                connection.sendall(str(len(chunk)).encode())
+            ok = hashlib.md5(image).hexdigest() == md5
+            connection.sendall(b"OK" if ok else b"ERROR")
+        finally:
+            connection.close()
+        self.log("%s %s image of %d bytes" % (
+            "received" if ok else "CORRUPT", "fs" if command else "flash",
+            len(image)))
+        if ok and self.output_dir:
+            with open(os.path.join(self.output_dir, "%d.bin" % self.port),
+                      "wb") as fp:
+                fp.write(image)
+
+
+def parse_ports(value):
+    ports = []
+    for item in value.split(","):
+        first, _, last = item.partition("-")
+        ports.extend(range(int(first), int(last or first) + 1))
+    return ports
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--ports", default="8266",
+                        help="UDP ports, e.g. 8266-8281")
+    parser.add_argument("--auth", help="password of the devices")
+    parser.add_argument("--fail", type=int, default=0,
+                        help="invitations every device drops first")
+    parser.add_argument("--output-dir", help="keeps the received images")
+    args = parser.parse_args()
+
+    receivers = [
+        Receiver(port, args.auth, args.fail, args.output_dir)
+        for port in parse_ports(args.ports)
+    ]
+    for receiver in receivers:
+        receiver.start()
+    print("Listening on %d ports, Ctrl+C to stop" % len(receivers))
+    try:
+        for receiver in receivers:
+            receiver.join()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -31,3 +31,4 @@ if "nobuild" not in COMMAND_LINE_TARGETS:
     SConscript(
         join(DefaultEnvironment().PioPlatform().get_package_dir(
             "framework-arduinoespressif8266"), "tools", "platformio-build.py"))
+    DefaultEnvironment().ConfigureStackUsage()
@@ -170,3 +170,5 @@ libs.append(env.BuildLibrary(
 ))
 
 env.Prepend(LIBS=libs)
+
+env.ConfigureStackUsage()
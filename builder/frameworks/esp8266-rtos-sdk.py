@@ -171,3 +171,5 @@ libs.append(env.BuildLibrary(
 ))
 
 env.Prepend(LIBS=libs)
+
+env.ConfigureStackUsage()
@@ -15,9 +15,11 @@
 # pylint: disable=redefined-outer-name
 
 import functools
+import hashlib
+import os
 import re
 import sys
-from os.path import join
+from os.path import dirname, isdir, isfile, join
 
 
 from SCons.Script import (COMMAND_LINE_TARGETS, AlwaysBuild,
@@ -47,6 +49,71 @@ def _parse_size(value):
     return value
 
 
+def _get_ld_cache_path():
+    # shared by all environments of the project
+    return join(env.subst("$PROJECT_WORKSPACE_DIR"), "ldsizes.json")
+
+
+def _load_ld_cache():
+    data = env.ReadJson(_get_ld_cache_path())
+    if isinstance(data, dict) and data.get("version") == LD_CACHE_VERSION:
+        return data.get("layouts", {})
+    return {}
+
+
+def _save_ld_cache(layouts):
+    try:
+        # parallel builds of other environments may write it at the same time
+        env.WriteJson(
+            _get_ld_cache_path(),
+            dict(version=LD_CACHE_VERSION, layouts=layouts))
+    except OSError:
+        pass
+
+
+def _get_ld_file_state(path):
+    st = os.stat(path)
+    return [path, st.st_mtime_ns, st.st_size]
+
+
+def _find_ld_include(name, script_dir):
+    # the linker looks into the directory of the script, then into -L paths
+    for lib_dir in [script_dir] + [env.subst(d) for d in env.get("LIBPATH", [])]:
+        path = join(lib_dir, name)
+        if isfile(path):
+            return os.path.abspath(path)
+    return None
+
+
+def _read_ld_layout(ldscript_path, fs_prefix, deps, includes):
+    layout_re = re.compile(
+        r"(?:irom0_0_seg\s*:[^\n]+len\s*=\s*(?P<app_size>0x[\da-f]+))"
+        r"|(?:PROVIDE\s*\(\s*_%s_(?P<fs_key>\w+)\s*=\s*(?P<fs_value>0x[\da-f]+)\s*\))"
+        r"|(?:\bINCLUDE\s+\"?(?P<include>[^\"\s;]+))" % fs_prefix,
+        flags=re.I,
+    )
+    deps.append(_get_ld_file_state(ldscript_path))
+    with open(ldscript_path) as fp:
+        text = re.sub(r"/\*.*?\*/", "", fp.read(), flags=re.S)
+    result = {}
+    for match in layout_re.finditer(text):
+        if match.group("app_size"):
+            result['app_size'] = _parse_size(match.group("app_size"))
+        elif match.group("fs_key"):
+            result['fs_%s' % match.group("fs_key")] = _parse_size(
+                match.group("fs_value"))
+        else:
+            include_path = _find_ld_include(
+                match.group("include"), dirname(ldscript_path))
+            # checked again on load, an include may show up or move later
+            includes.append(
+                [match.group("include"), dirname(ldscript_path), include_path])
+            if include_path and include_path not in [d[0] for d in deps]:
+                result.update(_read_ld_layout(
+                    include_path, fs_prefix, deps, includes))
+    return result
+
+
 @functools.lru_cache(maxsize=None)
 def _parse_ld_sizes(ldscript_path):
     assert ldscript_path
@@ -58,27 +125,28 @@ def _parse_ld_sizes(ldscript_path):
     if match:
         result['flash_size'] = _parse_size(match.group(1))
 
-    appsize_re = re.compile(
-        r"irom0_0_seg\s*:.+len\s*=\s*(0x[\da-f]+)", flags=re.I)
-    filesystem_re = re.compile(
-        r"PROVIDE\s*\(\s*_%s_(\w+)\s*=\s*(0x[\da-f]+)\s*\)" % "FS"
-        if "arduino" in env.subst("$PIOFRAMEWORK")
-        else "SPIFFS",
-        flags=re.I,
-    )
-    with open(ldscript_path) as fp:
-        for line in fp.readlines():
-            line = line.strip()
-            if not line or line.startswith("/*"):
-                continue
-            match = appsize_re.search(line)
-            if match:
-                result['app_size'] = _parse_size(match.group(1))
-                continue
-            match = filesystem_re.search(line)
-            if match:
-                result['fs_%s' % match.group(1)] = _parse_size(
-                    match.group(2))
+    fs_prefix = "FS" if "arduino" in env.subst("$PIOFRAMEWORK") else "SPIFFS"
+    ldscript_path = os.path.abspath(ldscript_path)
+    key = "%s:%s" % (fs_prefix, ldscript_path)
+    layouts = _load_ld_cache()
+    cached = layouts.get(key)
+    try:
+        if cached and all(
+                _get_ld_file_state(dep[0]) == dep
+                for dep in cached['deps']) and all(
+                    _find_ld_include(name, script_dir) == path
+                    for name, script_dir, path in cached['includes']):
+            result.update(cached['sizes'])
+            return result
+    except OSError:
+        pass
+
+    deps = []
+    includes = []
+    sizes = _read_ld_layout(ldscript_path, fs_prefix, deps, includes)
+    layouts[key] = dict(deps=deps, includes=includes, sizes=sizes)
+    _save_ld_cache(layouts)
+    result.update(sizes)
     return result
 
 
@@ -120,6 +188,111 @@ def __fetch_fs_size(target, source, env):
     return (target, source)
 
 
+def _get_fs_manifest(env, data_dir):
+    """Everything the file system image is made of"""
+    files = []
+    for root, dirs, names in os.walk(data_dir):
+        dirs.sort()
+        for name in sorted(names):
+            path = join(root, name)
+            with open(path, "rb") as fp:
+                digest = hashlib.sha1(fp.read()).hexdigest()
+            files.append([
+                os.path.relpath(path, data_dir).replace(os.sep, "/"),
+                os.path.getsize(path), digest])
+    return dict(
+        tool=env.subst("$MKFSTOOL"),
+        builder=env.BoardConfig().get("build.fs_builder", "tool"),
+        page=env["FS_PAGE"],
+        block=env["FS_BLOCK"],
+        size=env["FS_END"] - env["FS_START"],
+        files=files,
+    )
+
+
+def __build_fs_image(target, source, env):
+    image_path = str(target[0])
+    # board_build.fs_assets, the image is made of the processed copies
+    source = [env.Dir(env.PrepareFsAssets(str(source[0])))]
+    manifest = _get_fs_manifest(env, str(source[0]))
+    manifest_path = image_path + ".manifest.json"
+    if isfile(image_path) and env.ReadJson(manifest_path) == manifest:
+        print("File system image is up to date, %d files" % len(
+            manifest['files']))
+        return 0
+    # fail before the tool runs out of space half way through
+    if not env.CheckFsUsage(str(source[0]), filesystem):
+        return 1
+    if env.GetFsBuilder(filesystem) == "python":
+        build = lambda target, source, env: env.BuildLittleFSImage(
+            str(source[0]), str(target[0]))
+    else:
+        build = "$MKFSCMD"
+    # VerboseAction gives back the bare command under `pio run -v`
+    result = env.Action(env.VerboseAction(
+        build,
+        "Building file system image from '$SOURCES' directory to $TARGET"
+    ))(target, source, env)
+    if not result:
+        env.WriteJson(manifest_path, manifest)
+    return result
+
+
+def _get_flash_regions(env, source):
+    if set(["uploadfs", "uploadfsota"]) & set(COMMAND_LINE_TARGETS):
+        return [(env["FS_START"], str(source[0]))]
+    regions = [(0, str(source[0]))] + [
+        (int(address, 0), env.subst(path))
+        for address, path in env.get("FLASH_EXTRA_IMAGES", [])
+    ]
+    # flashall, the file system image follows the firmware
+    if len(source) > 1:
+        regions.append((env["FS_START"], str(source[1])))
+    return regions
+
+
+def __write_flash_regions(target, source, env):
+    resets = get_esptoolpy_reset_flags(env.subst("$UPLOAD_RESETMETHOD"))
+    return env.WriteFlashRegions(
+        _get_flash_regions(env, source), resets[1], resets[3],
+        _parse_ld_sizes(env.GetActualLDScript())["flash_size"],
+        delta=env.IsUploadDeltaEnabled())
+
+
+def __flash_all(target, source, env):
+    resets = get_esptoolpy_reset_flags(env.subst("$UPLOAD_RESETMETHOD"))
+    return env.WriteFlashRegions(
+        _get_flash_regions(env, source), resets[1], resets[3],
+        _parse_ld_sizes(env.GetActualLDScript())["flash_size"],
+        delta=env.IsUploadDeltaEnabled(), skip=env.IsUploadSkipEnabled(),
+        fastest_baud=True)
+
+
+def _add_fs_image_target(env):
+    if filesystem not in ("littlefs", "spiffs"):
+        sys.stderr.write("Filesystem %s is not supported!\n" % filesystem)
+        env.Exit(1)
+    target = env.DataToBin(
+        join("$BUILD_DIR", "${ESP8266_FS_IMAGE_NAME}"), "$PROJECT_DATA_DIR")
+    env.NoCache(target)
+    # SCons does not see into the data directory, the action compares
+    # the manifest of the image instead
+    AlwaysBuild(target)
+    if env.IsImageCompressionEnabled():
+        env.AddPostAction(target, env.VerboseAction(
+            lambda source, target, env: env.CompressImage(
+                str(target[0]), firmware=False),
+            "Compressing $TARGET"))
+    return target
+
+
+def __bench_flash_regions(target, source, env):
+    resets = get_esptoolpy_reset_flags(env.subst("$UPLOAD_RESETMETHOD"))
+    return env.BenchFlashRegions(
+        _get_flash_regions(env, source), resets[1], resets[3],
+        _parse_ld_sizes(env.GetActualLDScript())["flash_size"])
+
+
 def _update_max_upload_size(env):
     ldsizes = _parse_ld_sizes(env.GetActualLDScript())
     if ldsizes and "app_size" in ldsizes:
@@ -141,7 +314,12 @@ def get_esptoolpy_reset_flags(resetmethod):
 
 ########################################################
 
+# bump when the layout of the cached linker script sizes changes
+LD_CACHE_VERSION = 2
+
 env = DefaultEnvironment()
+# JSON files, board options and output lines of all the scripts below
+env.SConscript("_helpers.py", exports="env")
 platform = env.PioPlatform()
 board = env.BoardConfig()
 filesystem = board.get("build.filesystem", "spiffs")
@@ -166,6 +344,14 @@ env.Replace(
     #
 
     MKFSTOOL="mk%s" % filesystem,
+    MKFSCMD=" ".join([
+        '"$MKFSTOOL"',
+        "-c", "$SOURCES",
+        "-p", "$FS_PAGE",
+        "-b", "$FS_BLOCK",
+        "-s", "${FS_END - FS_START}",
+        "$TARGET"
+    ]),
     ESP8266_FS_IMAGE_NAME=env.get("ESP8266_FS_IMAGE_NAME", env.get(
         "SPIFFSNAME", filesystem)),
 
@@ -193,6 +379,24 @@ env.Replace(
 if env.get("PROGNAME", "program") == "program":
     env.Replace(PROGNAME="firmware")
 
+# Program size is read from the ELF instead of running $SIZETOOL
+env.SConscript("_elf_size.py", exports="env")
+env.SConscript("_size_history.py", exports="env")
+# Worst-case stack depth, the frameworks call env.ConfigureStackUsage()
+env.SConscript("_stack_usage.py", exports="env")
+# Minified and compressed web assets of the file system image
+env.SConscript("_fs_assets.py", exports="env")
+# Usage prediction and the in-process LittleFS builder
+env.SConscript("_fs_image.py", exports="env")
+# Uploads of the changed regions and sectors only, esptool runs in-process
+env.SConscript("_flash_session.py", exports="env")
+# The same upload to many serial ports at once
+env.SConscript("_multi_upload.py", exports="env")
+# OTA rollouts to an inventory of hosts
+env.SConscript("_ota_rollout.py", exports="env")
+# Gzip copies of the images for compressed OTA updates
+env.SConscript("_image_compression.py", exports="env")
+
 #
 # Keep support for old LD Scripts
 #
@@ -202,17 +406,16 @@ env.Replace(BUILD_FLAGS=[
     for f in env.get("BUILD_FLAGS", [])
 ])
 
+# the linker map attributes every byte of the image to its object file,
+# written for `memmap` only, the changed flags relink the firmware once
+if "memmap" in COMMAND_LINE_TARGETS:
+    env.Append(LINKFLAGS=["-Wl,-Map=${BUILD_DIR}/${PROGNAME}.map"])
+
 env.Append(
     BUILDERS=dict(
         DataToBin=Builder(
-            action=env.VerboseAction(" ".join([
-                '"$MKFSTOOL"',
-                "-c", "$SOURCES",
-                "-p", "$FS_PAGE",
-                "-b", "$FS_BLOCK",
-                "-s", "${FS_END - FS_START}",
-                "$TARGET"
-            ]), "Building file system image from '$SOURCES' directory to $TARGET"),
+            # the image is rebuilt only when the files or the layout change
+            action=env.Action(__build_fs_image, None),
             emitter=__fetch_fs_size,
             source_factory=env.Dir,
             suffix=".bin"
@@ -226,6 +429,10 @@ env.Append(
 #
 
 target_elf = None
+# flashall writes the file system image along with the firmware
+target_fs = None
+with_fs = "flashall" in COMMAND_LINE_TARGETS and isdir(
+    env.subst("$PROJECT_DATA_DIR"))
 if "nobuild" in COMMAND_LINE_TARGETS:
     target_elf = join("$BUILD_DIR", "${PROGNAME}.elf")
     if set(["uploadfs", "uploadfsota"]) & set(COMMAND_LINE_TARGETS):
@@ -233,20 +440,23 @@ if "nobuild" in COMMAND_LINE_TARGETS:
         target_firm = join("$BUILD_DIR", "${ESP8266_FS_IMAGE_NAME}.bin")
     else:
         target_firm = join("$BUILD_DIR", "${PROGNAME}.bin")
+        if with_fs:
+            fetch_fs_size(env)
+            target_fs = join("$BUILD_DIR", "${ESP8266_FS_IMAGE_NAME}.bin")
 else:
     target_elf = env.BuildProgram()
     if set(["buildfs", "uploadfs", "uploadfsota"]) & set(COMMAND_LINE_TARGETS):
-        if filesystem not in ("littlefs", "spiffs"):
-            sys.stderr.write("Filesystem %s is not supported!\n" % filesystem)
-            env.Exit(1)
-        target_firm = env.DataToBin(
-            join("$BUILD_DIR", "${ESP8266_FS_IMAGE_NAME}"), "$PROJECT_DATA_DIR")
-        env.NoCache(target_firm)
-        AlwaysBuild(target_firm)
+        target_firm = _add_fs_image_target(env)
     else:
         target_firm = env.ElfToBin(
             join("$BUILD_DIR", "${PROGNAME}"), target_elf)
         env.Depends(target_firm, "checkprogsize")
+        if env.IsImageCompressionEnabled():
+            env.AddPostAction(target_firm, env.VerboseAction(
+                lambda source, target, env: env.CompressImage(str(target[0])),
+                "Compressing $TARGET"))
+        if with_fs:
+            target_fs = _add_fs_image_target(env)
 
 env.AddPlatformTarget("buildfs", target_firm, target_firm, "Build Filesystem Image")
 AlwaysBuild(env.Alias("nobuild", target_firm))
@@ -270,11 +480,56 @@ elif set(["checkprogsize", "upload"]) & set(COMMAND_LINE_TARGETS):
 target_size = env.AddPlatformTarget(
     "size",
     target_elf,
-    env.VerboseAction("$SIZEPRINTCMD", "Calculating size $SOURCE"),
+    env.VerboseAction(
+        lambda source, target, env: env.PrintProgramSizes(str(source[0])),
+        "Calculating size $SOURCE"),
     "Program Size",
     "Calculate program size",
 )
 
+#
+# Target: Accept the size of the last build as the new baseline
+#
+
+env.AddPlatformTarget(
+    "sizebaseline",
+    None,
+    env.VerboseAction(
+        lambda source, target, env: env.UpdateSizeBaseline(),
+        "Updating size baseline"),
+    "Set Size Baseline",
+    "Compare the size of the next builds with the last one",
+)
+
+#
+# Target: Worst-case stack depth of the entry points
+#
+
+env.AddPlatformTarget(
+    "stackusage",
+    target_elf,
+    env.VerboseAction(
+        lambda source, target, env: env.PrintStackUsage(),
+        "Analyzing stack usage"),
+    "Stack Usage",
+    "Show the worst-case stack depth, needs board_build.stack_usage = yes",
+)
+
+#
+# Target: Show the largest symbols of every memory region
+#
+
+env.AddPlatformTarget(
+    "memmap",
+    target_elf,
+    env.VerboseAction(
+        lambda source, target, env: env.PrintMemoryMap(
+            str(source[0]), env.subst("${BUILD_DIR}/${PROGNAME}.map")),
+        "Analyzing memory map of $SOURCE"),
+    "Memory Map",
+    "Show the largest symbols, objects and libraries of every memory region",
+)
+
 #
 # Target: Upload firmware or filesystem image
 #
@@ -294,7 +549,7 @@ if (upload_protocol != "espota"
         "project configuration file.\n")
 
 if upload_protocol == "espota":
-    if not env.subst("$UPLOAD_PORT"):
+    if not env.subst("$UPLOAD_PORT") and not env.IsOtaRollout():
         sys.stderr.write(
             "Error: Please specify IP address or host name of ESP device "
             "using `upload_port` for build environment or use "
@@ -310,6 +565,12 @@ if upload_protocol == "espota":
     )
     if set(["uploadfs", "uploadfsota"]) & set(COMMAND_LINE_TARGETS):
         env.Append(UPLOADERFLAGS=["-s"])
+    elif env.IsCompressedOtaSupported() and (
+            "nobuild" not in COMMAND_LINE_TARGETS or
+            isfile(env.subst(join("$BUILD_DIR", "${PROGNAME}.bin.gz")))):
+        # the updater of the Arduino core unpacks gzip firmware
+        env.Replace(UPLOADCMD=(
+            '"$PYTHONEXE" "$UPLOADER" $UPLOADERFLAGS -f ${SOURCE}.gz'))
     upload_actions = [env.VerboseAction("$UPLOADCMD", "Uploading $SOURCE")]
 
 elif upload_protocol == "esptool":
@@ -348,6 +609,10 @@ elif upload_protocol == "esptool":
                           "Looking for upload port..."),
         env.VerboseAction("$UPLOADCMD", "Uploading $SOURCE")
     ]
+    # only the regions and sectors the chip does not have yet
+    if env.IsUploadSkipEnabled():
+        upload_actions[-1] = env.VerboseAction(
+            __write_flash_regions, "Uploading changed regions of $SOURCE")
 
 # custom upload tool
 elif upload_protocol == "custom":
@@ -356,11 +621,68 @@ elif upload_protocol == "custom":
 else:
     sys.stderr.write("Warning! Unknown upload protocol %s\n" % upload_protocol)
 
+# production jigs, the image goes to all of board_build.upload_ports at once
+if upload_protocol == "esptool" and env.IsMultiPortUpload():
+    if env.IsUploadSkipEnabled():
+        sys.stderr.write(
+            "Warning! board_build.upload_skip_identical and upload_delta do "
+            "not apply to board_build.upload_ports, every port gets the full "
+            "image\n")
+    upload_actions = [env.VerboseAction(
+        lambda source, target, env: env.UploadToPorts(target, source),
+        "Uploading $SOURCE to board_build.upload_ports")]
+
+# fleets, the image goes to all hosts of board_build.ota_inventory
+if upload_protocol == "espota" and env.IsOtaRollout():
+    upload_actions = [env.VerboseAction(
+        lambda source, target, env: env.RolloutOta(
+            str(source[0]),
+            fs=bool(set(["uploadfs", "uploadfsota"]) & set(
+                COMMAND_LINE_TARGETS))),
+        "Rolling out $SOURCE to board_build.ota_inventory")]
+
 env.AddPlatformTarget("upload", target_firm, upload_actions, "Upload")
 env.AddPlatformTarget("uploadfs", target_firm, upload_actions, "Upload Filesystem Image")
 env.AddPlatformTarget(
     "uploadfsota", target_firm, upload_actions, "Upload Filesystem Image OTA")
 
+#
+# Target: Flash firmware, SDK images and file system image in one session
+#
+
+if upload_protocol == "esptool":
+    env.AddPlatformTarget(
+        "flashall",
+        [target_firm, target_fs] if target_fs else target_firm,
+        [
+            env.VerboseAction(env.AutodetectUploadPort,
+                              "Looking for upload port..."),
+            env.VerboseAction(__flash_all, "Flashing all images")
+        ],
+        "Flash All",
+        "Write the firmware, the SDK images and the file system image in one "
+        "esptool session at the fastest working baud rate",
+    )
+
+#
+# Target: Compare sector delta writes with full writes on the device
+#
+
+if upload_protocol == "esptool":
+    env.AddPlatformTarget(
+        "flashbench",
+        target_firm,
+        [
+            env.VerboseAction(env.AutodetectUploadPort,
+                              "Looking for upload port..."),
+            env.VerboseAction(__bench_flash_regions,
+                              "Benchmarking the upload of $SOURCE")
+        ],
+        "Flash Benchmark",
+        "Upload the changed sectors, then all of the image again, and "
+        "compare bytes sent and time",
+    )
+
 #
 # Target: Erase Flash
 #
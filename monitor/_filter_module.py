@@ -0,0 +1,33 @@
+# Copyright (c) 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Loads the esp8266_exception_decoder filter outside of the device monitor,
+for the scripts of this directory.
+"""
+
+import importlib.util
+import os
+
+MONITOR_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def load_filter_module():
+    spec = importlib.util.spec_from_file_location(
+        "filter_exception_decoder",
+        os.path.join(MONITOR_DIR, "filter_exception_decoder.py"),
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
@@ -0,0 +1,310 @@
+# Copyright (c) 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Replays serial logs through the esp8266_exception_decoder monitor filter and
+reports the throughput of rx() and the worst latency of a single call.
+
+Addresses are answered by a fake addr2line, so neither a toolchain nor
+a firmware is needed:
+
+    python bench_exception_decoder.py [--chunk-size N ...] [LOG ...]
+
+Without logs, a synthetic one is generated: crash storms, lines longer
+than the 4096 bytes line buffer and stray carriage returns.
+
+With a firmware, the decoding of a stack dump is timed against the real
+addr2line instead, the long-lived process against one process per frame:
+
+    python bench_exception_decoder.py --elf firmware.elf --addr2line PATH
+"""
+
+import argparse
+import hashlib
+import os
+import random
+import subprocess
+import tempfile
+import threading
+import time
+
+from _filter_module import load_filter_module
+
+
+class FakeAddr2Line(object):
+    """Stands in for Addr2Line, answers every address after `delay` seconds"""
+
+    def __init__(self, firmware_path, delay):
+        self.firmware_path = firmware_path
+        self.delay = delay
+
+    def lookup(self, addresses):
+        if self.delay:
+            time.sleep(self.delay * len(addresses))
+        return [
+            "func_%s at src/main.cpp:%d" % (addr[-4:], int(addr, 16) % 997)
+            for addr in addresses
+        ]
+
+    def kill(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def create_decoder(module, firmware_path, delay):
+    class ReplayDecoder(module.Esp8266ExceptionDecoder):
+        def __init__(self):  # pylint: disable=super-init-not-called
+            # there is no project to take the configuration from
+            self.project_dir = os.getcwd()
+            self.setup_decoder()
+            resolver = module.FirmwareResolver(firmware_path, None)
+            resolver.firmware_mtime = os.path.getmtime(firmware_path)
+            with open(firmware_path, "rb") as fp:
+                resolver.firmware_hash = hashlib.sha1(fp.read()).hexdigest()
+            resolver.addr2line = FakeAddr2Line(firmware_path, delay)
+            self.resolver = module.ImageSet([resolver])
+            self.resolver.build_index()
+            self.enabled = True
+            threading.Thread(target=self.decode_worker, daemon=True).start()
+
+    return ReplayDecoder()
+
+
+def generate_crash(rng):
+    def word():
+        if rng.random() < 0.4:
+            return "%08x" % rng.randrange(0x40100000, 0x40300000, 4)
+        return "%08x" % rng.randrange(0x3FFE8000, 0x40000000)
+
+    sp = 0x3FFFFDD0
+    lines = [
+        "",
+        "Exception (%d):" % rng.choice((0, 3, 6, 9, 28, 29)),
+        "epc1=0x%08x epc2=0x00000000 epc3=0x00000000 excvaddr=0x%08x "
+        "depc=0x00000000" % (rng.randrange(0x40200000, 0x40300000, 4), sp),
+        "",
+        ">>>stack>>>",
+        "",
+        "ctx: cont",
+        "sp: %08x end: 3fffffc0 offset: 0190" % sp,
+    ]
+    for _ in range(rng.randint(16, 40)):
+        lines.append("%08x:  %s" % (sp, " ".join(word() for _ in range(4))))
+        sp += 16
+    lines += [
+        "<<<stack<<<",
+        "",
+        " ets Jan  8 2013,rst cause:2, boot mode:(3,6)",
+        "",
+    ]
+    return "\r\n".join(lines) + "\r\n"
+
+
+def generate_log(crashes, seed=0):
+    rng = random.Random(seed)
+    chunks = []
+    uptime = 0
+    while crashes > 0:
+        for _ in range(rng.randint(20, 80)):
+            uptime += rng.randint(1, 500)
+            chunks.append(
+                "[%10d] heap=%d rssi=%d%s"
+                % (
+                    uptime,
+                    rng.randint(20000, 45000),
+                    -rng.randint(30, 90),
+                    rng.choice(("\r\n", "\n", "\r\r\n", "\r\n\r\n", "\n\r")),
+                )
+            )
+        if rng.random() < 0.2:
+            chunks.append("%s\r\n" % ("#" * rng.randint(4097, 16384)))
+        # a boot loop crashes right after the reset
+        storm = rng.randint(5, 30) if rng.random() < 0.2 else 1
+        for _ in range(min(storm, crashes)):
+            chunks.append(generate_crash(rng))
+            crashes -= 1
+    return "".join(chunks)
+
+
+def replay(module, text, chunk_size, firmware_path, delay, baud=None):
+    decoder = create_decoder(module, firmware_path, delay)
+    latencies = []
+    output = []
+    started = time.perf_counter()
+    for i in range(0, len(text), chunk_size):
+        if baud:
+            # 10 bits per byte on the wire, 8N1
+            arrival = started + (i + chunk_size) * 10.0 / baud
+            time.sleep(max(0, arrival - time.perf_counter()))
+        chunk_started = time.perf_counter()
+        output.append(decoder.rx(text[i : i + chunk_size]))
+        latencies.append(time.perf_counter() - chunk_started)
+
+    while not decoder.decode_queue.empty() or decoder.decode_started is not None:
+        time.sleep(0.01)
+    # flush what the decoder thread finished after the last chunk
+    output.append(decoder.rx("\n"))
+    output = "".join(output)
+
+    latencies.sort()
+    return dict(
+        mbps=len(text.encode("utf-8")) / sum(latencies) / 1024 / 1024,
+        worst=latencies[-1],
+        p99=latencies[int(len(latencies) * 0.99)],
+        decoded=output.count("--- decoded crash #"),
+        skipped=decoder.skipped_count,
+    )
+
+
+def get_dump_addresses(module, firmware_path, frames, seed=0):
+    """Code addresses of the firmware, as many as a stack dump decodes"""
+    ranges = module.ElfFile(firmware_path).get_code_ranges()
+    if not ranges:
+        raise ValueError("%s has no code sections" % firmware_path)
+    rng = random.Random(seed)
+    addresses = []
+    for _ in range(frames):
+        start, end = rng.choice(ranges)
+        addresses.append("%08x" % rng.randrange(start, end))
+    return addresses
+
+
+def lookup_per_call(addr2line_path, firmware_path, addresses):
+    """One addr2line process per address, how the decoder used to run it"""
+    args = [addr2line_path, "-fipC", "-e", firmware_path]
+    return [
+        subprocess.check_output(args + [addr]).decode("utf-8").strip()
+        for addr in addresses
+    ]
+
+
+def bench_addr2line(module, addr2line_path, firmware_path, frames, repeat):
+    addresses = get_dump_addresses(module, firmware_path, frames)
+
+    started = time.perf_counter()
+    expected = lookup_per_call(addr2line_path, firmware_path, addresses)
+    per_call = time.perf_counter() - started
+
+    addr2line = module.Addr2Line(addr2line_path, firmware_path)
+    timings = []
+    try:
+        for _ in range(repeat):
+            started = time.perf_counter()
+            result = addr2line.lookup(addresses)
+            timings.append(time.perf_counter() - started)
+    finally:
+        addr2line.close()
+
+    return dict(
+        per_call=per_call,
+        # the first dump starts the process
+        first=timings[0],
+        warm=min(timings[1:] or timings),
+        mismatches=sum(1 for a, b in zip(expected, result) if a != b),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("logs", nargs="*", help="captured serial logs to replay")
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        action="append",
+        help="bytes passed to every rx() call, can be repeated",
+    )
+    parser.add_argument(
+        "--crashes", type=int, default=500, help="crashes in the synthetic log"
+    )
+    parser.add_argument(
+        "--baud",
+        type=int,
+        help="pace the chunks as they would arrive over a serial line",
+    )
+    parser.add_argument(
+        "--addr2line-delay",
+        type=float,
+        default=0.0,
+        help="seconds the fake addr2line spends on every address",
+    )
+    parser.add_argument(
+        "--elf", help="firmware to decode with the real addr2line instead"
+    )
+    parser.add_argument("--addr2line", help="path to addr2line of the toolchain")
+    parser.add_argument(
+        "--frames", type=int, default=128, help="stack frames in the timed dump"
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=5, help="dumps decoded by the long-lived process"
+    )
+    args = parser.parse_args()
+
+    if args.elf:
+        if not args.addr2line:
+            parser.error("--addr2line is required with --elf")
+        result = bench_addr2line(
+            load_filter_module(), args.addr2line, args.elf, args.frames, args.repeat
+        )
+        print(
+            "%d frames: %8.1f ms one process per frame, %8.1f ms long-lived "
+            "process (%.1f ms with its start), %.1fx faster, %d different results"
+            % (
+                args.frames,
+                result["per_call"] * 1000,
+                result["warm"] * 1000,
+                result["first"] * 1000,
+                result["per_call"] / max(result["warm"], 1e-6),
+                result["mismatches"],
+            )
+        )
+        return
+
+    if args.logs:
+        text = ""
+        for path in args.logs:
+            # miniterm decodes serial data the same way
+            with open(path, encoding="utf-8", errors="replace", newline="") as fp:
+                text += fp.read()
+    else:
+        text = generate_log(args.crashes)
+
+    module = load_filter_module()
+    with tempfile.NamedTemporaryFile(suffix=".elf", delete=False) as fp:
+        fp.write(b"\x7fELF")
+    try:
+        print("Replaying %d bytes" % len(text))
+        for chunk_size in args.chunk_size or (16, 64, 256, 1024, 4096, 65536):
+            result = replay(
+                module, text, chunk_size, fp.name, args.addr2line_delay, args.baud
+            )
+            print(
+                "chunk %6d B: %8.2f MB/s, worst rx() %8.3f ms, p99 %7.3f ms, "
+                "%d blocks decoded, %d decodes skipped"
+                % (
+                    chunk_size,
+                    result["mbps"],
+                    result["worst"] * 1000,
+                    result["p99"] * 1000,
+                    result["decoded"],
+                    result["skipped"],
+                )
+            )
+    finally:
+        os.remove(fp.name)
+
+
+if __name__ == "__main__":
+    main()
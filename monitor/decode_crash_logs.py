@@ -0,0 +1,205 @@
+# Copyright (c) 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Decodes captured serial crash logs in bulk, outside of a monitor session,
+and writes one JSON record per log (JSON Lines):
+
+    python decode_crash_logs.py --elf firmware.elf LOG [LOG ...]
+    python decode_crash_logs.py --manifest manifest.txt
+
+A manifest lists a "<log> <firmware.elf>" pair per line. The logs are spread
+over a process pool. The symbol index of every firmware is built once before
+the workers start, and all of them memory-map it.
+"""
+
+import argparse
+import collections
+import concurrent.futures
+import json
+import os
+import shutil
+import sys
+
+from _filter_module import load_filter_module
+
+ADDR2LINE = "xtensa-lx106-elf-addr2line"
+
+
+# loaded at import time, so every pool worker has it as well
+decoder = load_filter_module()
+_resolvers = {}
+
+
+def find_addr2line():
+    path = shutil.which(ADDR2LINE)
+    if path:
+        return path
+    core_dir = os.getenv(
+        "PLATFORMIO_CORE_DIR", os.path.join(os.path.expanduser("~"), ".platformio")
+    )
+    path = os.path.join(core_dir, "packages", "toolchain-xtensa", "bin", ADDR2LINE)
+    if decoder.IS_WINDOWS:
+        path += ".exe"
+    return path if os.path.isfile(path) else None
+
+
+def get_resolver(
+    firmware_path, addr2line_path, project_dir, rom_ld_script, index_dir
+):
+    if firmware_path not in _resolvers:
+        resolver = decoder.FirmwareResolver(
+            firmware_path,
+            addr2line_path,
+            project_dir,
+            rom_ld_script=rom_ld_script,
+            index_dir=index_dir,
+        )
+        resolver.open_firmware(background=False)
+        _resolvers[firmware_path] = resolver
+    return _resolvers[firmware_path]
+
+
+def parse_frames(output):
+    """Splits addr2line output into frames, the innermost first"""
+    frames = []
+    for line in output.split("\n"):
+        line = line.strip()
+        if line.startswith("(inlined by) "):
+            line = line[len("(inlined by) ") :]
+        function, sep, location = line.rpartition(" at ")
+        if not sep:
+            function, location = line, None
+        frames.append(dict(function=function, location=location))
+    return frames
+
+
+def decode_log(task):
+    log_path, firmware_path = task[:2]
+    resolver = get_resolver(firmware_path, *task[2:])
+    crashes = collections.OrderedDict()
+
+    def get_crash(crash_id):
+        return crashes.setdefault(
+            crash_id,
+            dict(id=crash_id, exception=None, registers={}, stack=[]),
+        )
+
+    def on_exception(crash_id, code, registers):
+        crash = get_crash(crash_id)
+        description = None
+        if code < len(decoder.Esp8266ExceptionDecoder.EXCEPTION_CODES):
+            description = decoder.Esp8266ExceptionDecoder.EXCEPTION_CODES[code]
+        crash["exception"] = dict(code=code, description=description)
+        lines = resolver.get_lines([value for _, value in registers])
+        for (name, value), output in zip(registers, lines):
+            crash["registers"][name] = dict(
+                value=value, frames=parse_frames(output) if output else []
+            )
+
+    def on_stack(crash_id, words):
+        crash = get_crash(crash_id)
+        addresses = [w for w in words if resolver.is_addr_ok(w)]
+        for addr, output in zip(addresses, resolver.get_lines(addresses)):
+            if output is not None:
+                crash["stack"].append(
+                    dict(address="0x" + addr, frames=parse_frames(output))
+                )
+
+    parser = decoder.CrashParser(on_exception, on_stack)
+    try:
+        # miniterm decodes serial data the same way
+        with open(log_path, encoding="utf-8", errors="replace", newline="") as fp:
+            parser.feed(fp.read())
+    except OSError as e:
+        return dict(log=log_path, firmware=firmware_path, error=str(e))
+    parser.finish()
+    return dict(log=log_path, firmware=firmware_path, crashes=list(crashes.values()))
+
+
+def read_manifest(path):
+    result = []
+    with open(path) as fp:
+        for line in fp:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                log_path, firmware_path = line.rsplit(None, 1)
+                result.append((log_path, firmware_path))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("logs", nargs="*", help="logs decoded against --elf")
+    parser.add_argument("--elf", help="firmware the logs were captured from")
+    parser.add_argument("--manifest", help='file with "<log> <firmware.elf>" lines')
+    parser.add_argument("--addr2line", help="path to %s" % ADDR2LINE)
+    parser.add_argument("--project-dir", help="stripped from source paths")
+    parser.add_argument(
+        "--rom-ld-script", help="eagle.rom.addr.v6.ld of the SDK, names ROM frames"
+    )
+    parser.add_argument(
+        "--index-dir", help="keeps the symbol indexes, next to every ELF by default"
+    )
+    parser.add_argument("-j", "--jobs", type=int, help="worker processes")
+    parser.add_argument("-o", "--output", help="JSON Lines file, stdout by default")
+    args = parser.parse_args()
+
+    pairs = read_manifest(args.manifest) if args.manifest else []
+    if args.logs:
+        if not args.elf:
+            parser.error("--elf is required to decode the listed logs")
+        pairs.extend((log_path, args.elf) for log_path in args.logs)
+    if not pairs:
+        parser.error("nothing to decode")
+
+    addr2line_path = args.addr2line or find_addr2line()
+    if not addr2line_path:
+        parser.error("%s is not found, please specify --addr2line" % ADDR2LINE)
+    project_dir = os.path.abspath(args.project_dir) if args.project_dir else None
+
+    # logs of the same firmware go to the same workers
+    pairs.sort(key=lambda pair: pair[1])
+    for firmware_path in sorted(set(pair[1] for pair in pairs)):
+        get_resolver(
+            firmware_path,
+            addr2line_path,
+            project_dir,
+            args.rom_ld_script,
+            args.index_dir,
+        )
+
+    tasks = [
+        (
+            log_path,
+            firmware_path,
+            addr2line_path,
+            project_dir,
+            args.rom_ld_script,
+            args.index_dir,
+        )
+        for log_path, firmware_path in pairs
+    ]
+    output = open(args.output, "w") if args.output else sys.stdout
+    try:
+        with concurrent.futures.ProcessPoolExecutor(args.jobs) as executor:
+            for record in executor.map(decode_log, tasks, chunksize=16):
+                output.write(json.dumps(record) + "\n")
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+
+if __name__ == "__main__":
+    main()
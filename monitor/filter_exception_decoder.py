@@ -12,16 +12,33 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import array
+import atexit
+import bisect
+import collections
+import hashlib
+import mmap
 import os
+import queue
 import re
+import struct
 import subprocess
 import sys
+import threading
+import time
 
-from platformio.project.exception import PlatformioException
-from platformio.public import (
-    DeviceMonitorFilterBase,
-    load_build_metadata,
-)
+try:
+    from platformio.project.exception import PlatformioException
+    from platformio.public import (
+        DeviceMonitorFilterBase,
+        load_build_metadata,
+    )
+except ImportError:
+    # decode_crash_logs.py and bench_exception_decoder.py use the decoding
+    # classes without PlatformIO, only PlatformIO loads the filter itself
+    PlatformioException = Exception
+    DeviceMonitorFilterBase = object
+    load_build_metadata = None
 
 
 # By design, __init__ is called inside miniterm and we can't pass context to it.
@@ -30,19 +47,1121 @@ from platformio.public import (
 IS_WINDOWS = sys.platform.startswith("win")
 
 
-class Esp8266ExceptionDecoder(
-    DeviceMonitorFilterBase
-):  # pylint: disable=too-many-instance-attributes
-    NAME = "esp8266_exception_decoder"
+class Addr2Line(object):
+    """Long-lived addr2line process that resolves addresses fed over stdin"""
 
-    # https://github.com/esp8266/esp8266-wiki/wiki/Memory-Map
-    ADDR_MIN = 0x40000000
-    ADDR_MAX = 0x40300000
+    # addr2line answers "0x00000000: ?? ??:0" for it, marks the end of a batch
+    SENTINEL = "0x0"
+    # keep each round trip well below the pipe buffer size
+    CHUNK_SIZE = 64
+
+    def __init__(self, addr2line_path, firmware_path):
+        self.addr2line_path = addr2line_path
+        self.firmware_path = firmware_path
+        self.encoding = "mbcs" if IS_WINDOWS else "utf-8"
+        self._proc = None
+
+    def start(self):
+        self._proc = subprocess.Popen(
+            [self.addr2line_path, u"-afipC", u"-e", self.firmware_path],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        )
+
+    def kill(self):
+        # called from another thread to unblock a lookup that hangs
+        proc = self._proc
+        if proc is not None:
+            proc.kill()
+
+    def close(self):
+        if self._proc is None:
+            return
+        try:
+            self._proc.stdin.close()
+            self._proc.wait(timeout=1)
+        except (OSError, subprocess.TimeoutExpired):
+            self._proc.kill()
+        self._proc = None
+
+    def lookup(self, addresses):
+        result = []
+        for i in range(0, len(addresses), self.CHUNK_SIZE):
+            result.extend(self._lookup_chunk(addresses[i : i + self.CHUNK_SIZE]))
+        return result
+
+    def _lookup_chunk(self, addresses):
+        if self._proc is None or self._proc.poll() is not None:
+            self.start()
+        try:
+            self._proc.stdin.write(
+                ("\n".join(addresses + [self.SENTINEL]) + "\n").encode()
+            )
+            self._proc.stdin.flush()
+            entries = self._read_entries()
+        except (OSError, ValueError):
+            self.close()
+            raise
+        if len(entries) != len(addresses):
+            self.close()
+            raise ValueError(
+                "expected %d entries, got %d" % (len(addresses), len(entries))
+            )
+        return entries
+
+    def _read_entries(self):
+        entries = []
+        while True:
+            line = self._proc.stdout.readline()
+            if not line:
+                raise ValueError("%s exited unexpectedly" % self.addr2line_path)
+            line = line.decode(self.encoding).rstrip()
+            if line.startswith("0x") and ": " in line:
+                addr, output = line.split(": ", 1)
+                if int(addr, 16) == 0:
+                    return entries
+                entries.append(output)
+            elif entries:
+                # " (inlined by) ..." frames of the previous address
+                entries[-1] += "\n" + line
+
+
+SHF_ALLOC = 0x2
+SHF_EXECINSTR = 0x4
+SHN_ABS = 0xFFF1
+
+ElfSection = collections.namedtuple(
+    "ElfSection", ["name", "type", "flags", "addr", "offset", "size"]
+)
+
+
+class ElfFile(object):
+    """Minimal reader of ELF section headers, enough to get at DWARF data"""
+
+    def __init__(self, path):
+        with open(path, "rb") as fp:
+            self.data = fp.read()
+        if self.data[:4] != b"\x7fELF":
+            raise ValueError("%s is not an ELF file" % path)
+        self.is64 = self.data[4] == 2
+        self.endian = "<" if self.data[5] == 1 else ">"
+        self.address_size = 8 if self.is64 else 4
+        self.sections = self._read_sections()
+
+    def _read_sections(self):
+        if self.is64:
+            shoff, = struct.unpack_from(self.endian + "Q", self.data, 0x28)
+            shentsize, shnum, shstrndx = struct.unpack_from(
+                self.endian + "3H", self.data, 0x3A
+            )
+            fmt = self.endian + "IIQQQQ"
+        else:
+            shoff, = struct.unpack_from(self.endian + "I", self.data, 0x20)
+            shentsize, shnum, shstrndx = struct.unpack_from(
+                self.endian + "3H", self.data, 0x2E
+            )
+            fmt = self.endian + "IIIIII"
+
+        headers = [
+            struct.unpack_from(fmt, self.data, shoff + i * shentsize)
+            for i in range(shnum)
+        ]
+        if not headers:
+            return []
+        names_offset = headers[shstrndx][4]
+        result = []
+        for name, type_, flags, addr, offset, size in headers:
+            start = names_offset + name
+            name = self.data[start : self.data.index(b"\0", start)].decode()
+            result.append(ElfSection(name, type_, flags, addr, offset, size))
+        return result
+
+    def get_section_data(self, name):
+        for section in self.sections:
+            if section.name == name:
+                return self.data[section.offset : section.offset + section.size]
+        return None
+
+    def iter_symbols(self):
+        """Yields (name, value, size, section index) of the symbol table"""
+        symtab = self.get_section_data(".symtab")
+        strtab = self.get_section_data(".strtab")
+        if not symtab or not strtab:
+            return
+        if self.is64:
+            entry = struct.Struct(self.endian + "IBBHQQ")
+        else:
+            entry = struct.Struct(self.endian + "IIIBBH")
+        for fields in entry.iter_unpack(symtab):
+            if self.is64:
+                name, _, _, shndx, value, size = fields
+            else:
+                name, value, size, _, _, shndx = fields
+            name = strtab[name : strtab.index(b"\0", name)].decode("utf-8", "replace")
+            yield name, value, size, shndx
+
+    def get_code_ranges(self):
+        flags = SHF_ALLOC | SHF_EXECINSTR
+        return sorted(
+            (section.addr, section.addr + section.size)
+            for section in self.sections
+            if section.flags & flags == flags and section.addr and section.size
+        )
+
+
+def _read_uleb128(data, offset):
+    result = shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        result |= (byte & 0x7F) << shift
+        shift += 7
+        if not byte & 0x80:
+            return result, offset
+
+
+def iter_line_ranges(elf):  # pylint: disable=too-many-locals,too-many-branches
+    """Yields (start, end) address ranges of the rows of the DWARF line table.
+
+    Only row boundaries are of interest here, the file and line of every row
+    are left to addr2line, so most of the header is skipped.
+    """
+    data = elf.get_section_data(".debug_line")
+    if not data:
+        return
+    endian = elf.endian
+    offset = 0
+    while offset < len(data):
+        unit_length, = struct.unpack_from(endian + "I", data, offset)
+        offset += 4
+        offset_fmt = "I"
+        if unit_length == 0xFFFFFFFF:
+            unit_length, = struct.unpack_from(endian + "Q", data, offset)
+            offset += 8
+            offset_fmt = "Q"
+        unit_end = offset + unit_length
+
+        version, = struct.unpack_from(endian + "H", data, offset)
+        offset += 2
+        address_size = elf.address_size
+        if version >= 5:
+            address_size = data[offset]
+            offset += 2  # address_size, segment_selector_size
+        header_length, = struct.unpack_from(endian + offset_fmt, data, offset)
+        offset += struct.calcsize(offset_fmt)
+        program_start = offset + header_length
+
+        min_inst_length = data[offset]
+        offset += 1
+        if version >= 4:
+            offset += 1  # maximum_operations_per_instruction
+        offset += 1  # default_is_stmt
+        line_range = data[offset + 1]
+        opcode_base = data[offset + 2]
+        std_lengths = data[offset + 3 : offset + 2 + opcode_base]
+        address_fmt = endian + ("Q" if address_size == 8 else "I")
+
+        offset = program_start
+        address = 0
+        rows = []
+        while offset < unit_end:
+            opcode = data[offset]
+            offset += 1
+            if opcode >= opcode_base:
+                opcode -= opcode_base
+                address += (opcode // line_range) * min_inst_length
+                rows.append(address)
+            elif opcode == 0:  # extended opcodes
+                length, offset = _read_uleb128(data, offset)
+                sub_opcode = data[offset]
+                if sub_opcode == 1:  # DW_LNE_end_sequence
+                    # sequences of discarded sections are relocated to 0
+                    if rows and rows[0]:
+                        rows.append(address)
+                        for i in range(len(rows) - 1):
+                            if rows[i] != rows[i + 1]:
+                                yield rows[i], rows[i + 1]
+                    address = 0
+                    rows = []
+                elif sub_opcode == 2:  # DW_LNE_set_address
+                    address, = struct.unpack_from(address_fmt, data, offset + 1)
+                offset += length
+            elif opcode == 1:  # DW_LNS_copy
+                rows.append(address)
+            elif opcode == 2:  # DW_LNS_advance_pc
+                value, offset = _read_uleb128(data, offset)
+                address += value * min_inst_length
+            elif opcode == 8:  # DW_LNS_const_add_pc
+                address += ((255 - opcode_base) // line_range) * min_inst_length
+            elif opcode == 9:  # DW_LNS_fixed_advance_pc
+                value, = struct.unpack_from(endian + "H", data, offset)
+                offset += 2
+                address += value
+            else:
+                for _ in range(std_lengths[opcode - 1]):
+                    _, offset = _read_uleb128(data, offset)
+        offset = unit_end
+
+
+class SymbolIndex(object):
+    """Address ranges of the firmware with their decoded addr2line output.
+
+    The index is stored in the index directory of the resolver, keyed by
+    the firmware hash, and memory-mapped, so every monitor session started
+    against the same firmware shares it. Lookups are a bisect over the sorted range starts.
+    """
+
+    MAGIC = 0x58444953  # "SIDX"
+    VERSION = 1
+    HEADER = struct.Struct("=4I")  # magic, version, ranges, strings
+    SUFFIX = ".symidx"
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as fp:
+            self._mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, version, ranges, strings = self.HEADER.unpack_from(self._mm)
+            if magic != self.MAGIC or version != self.VERSION:
+                raise ValueError("%s: unsupported symbol index" % path)
+            view = memoryview(self._mm)
+            offset = self.HEADER.size
+            self._views = []
+            for count in (ranges, ranges, ranges, strings + 1):
+                self._views.append(view[offset : offset + count * 4].cast("I"))
+                offset += count * 4
+            self._views.append(view[offset:])
+            view.release()
+        except (ValueError, TypeError, struct.error):
+            self._mm.close()
+            raise
+        (
+            self.starts,
+            self.ends,
+            self.string_ids,
+            self.string_offsets,
+            self.blob,
+        ) = self._views
+
+    def close(self):
+        for view in self._views:
+            view.release()
+        self._mm.close()
+
+    def __len__(self):
+        return len(self.starts)
+
+    def lookup(self, addr):
+        i = bisect.bisect_right(self.starts, addr) - 1
+        if i < 0 or addr >= self.ends[i]:
+            return None
+        string_id = self.string_ids[i]
+        return bytes(
+            self.blob[
+                self.string_offsets[string_id] : self.string_offsets[string_id + 1]
+            ]
+        ).decode("utf-8")
+
+    @classmethod
+    def get_path(cls, index_dir, firmware_path, firmware_hash):
+        return os.path.join(
+            index_dir,
+            "%s.%s%s"
+            % (os.path.basename(firmware_path), firmware_hash[:16], cls.SUFFIX),
+        )
+
+    @staticmethod
+    def resolve_ranges(ranges, addr2line):
+        """Decodes line table rows, splitting those that change the inline
+        frames midway until both ends of every range decode the same"""
+        outputs = {}
+        result = []
+        while ranges:
+            addresses = set()
+            for start, end in ranges:
+                addresses.update((start, end - 1))
+            addresses = sorted(addresses - set(outputs))
+            outputs.update(
+                zip(addresses, addr2line.lookup(["0x%x" % a for a in addresses]))
+            )
+
+            splits = []
+            for start, end in ranges:
+                if outputs[start] == outputs[end - 1]:
+                    result.append((start, end, outputs[start]))
+                else:
+                    middle = (start + end) // 2
+                    splits.extend([(start, middle), (middle, end)])
+            ranges = splits
+        return sorted(result)
+
+    @classmethod
+    def build(cls, path, elf, addr2line):
+        ranges = cls.resolve_ranges(sorted(set(iter_line_ranges(elf))), addr2line)
+
+        starts, ends, string_ids = (array.array("I") for _ in range(3))
+        strings = {}
+        for start, end, output in ranges:
+            if output == "?? ??:0":
+                continue
+            string_id = strings.setdefault(output, len(strings))
+            # merge with the previous range when it decodes the same
+            if ends and ends[-1] == start and string_ids[-1] == string_id:
+                ends[-1] = end
+                continue
+            starts.append(start)
+            ends.append(end)
+            string_ids.append(string_id)
+
+        blob = bytearray()
+        string_offsets = array.array("I", [0])
+        for output in strings:  # dicts preserve the insertion order
+            blob += output.encode("utf-8")
+            string_offsets.append(len(blob))
+
+        tmp_path = "%s.%d.tmp" % (path, os.getpid())
+        with open(tmp_path, "wb") as fp:
+            fp.write(
+                cls.HEADER.pack(cls.MAGIC, cls.VERSION, len(starts), len(strings))
+            )
+            for values in (starts, ends, string_ids, string_offsets):
+                fp.write(values.tobytes())
+            fp.write(blob)
+        os.replace(tmp_path, path)
+
+        # drop indexes of the previous builds of this firmware
+        prefix = os.path.basename(path).rsplit(".", 2)[0] + "."
+        for name in os.listdir(os.path.dirname(path) or "."):
+            stale = os.path.join(os.path.dirname(path), name)
+            if (
+                name.startswith(prefix)
+                and name.endswith(cls.SUFFIX)
+                and stale != path
+            ):
+                try:
+                    os.remove(stale)
+                except OSError:
+                    pass
+
+
+CrashRecord = collections.namedtuple("CrashRecord", "crash_id title pc count")
+
+CacheInfo = collections.namedtuple(
+    "CacheInfo", ["hits", "misses", "maxsize", "currsize"]
+)
+
+
+class AddressCache(object):
+    """Bounded LRU mapping of addresses to their decoded frames"""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = collections.OrderedDict()
+
+    def __getitem__(self, addr):
+        try:
+            value = self._data[addr]
+        except KeyError:
+            self.misses += 1
+            raise
+        self._data.move_to_end(addr)
+        self.hits += 1
+        return value
+
+    def __setitem__(self, addr, value):
+        self._data[addr] = value
+        self._data.move_to_end(addr)
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def __len__(self):
+        return len(self._data)
+
+    def clear(self):
+        self._data.clear()
+
+    def info(self):
+        return CacheInfo(self.hits, self.misses, self.maxsize, len(self._data))
+
+
+class LatencyHistogram(object):
+    """Counts durations in power-of-two microsecond buckets"""
+
+    BUCKETS = 32
+
+    def __init__(self):
+        self.buckets = [0] * self.BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.worst = 0.0
+
+    def add(self, seconds):
+        usec = int(seconds * 1000000)
+        self.buckets[min(usec.bit_length(), self.BUCKETS - 1)] += 1
+        self.count += 1
+        self.total += seconds
+        self.worst = max(self.worst, seconds)
+
+    def percentile(self, fraction):
+        """Upper bound of the bucket the percentile falls into, in seconds"""
+        rank = self.count * fraction
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if n and seen >= rank:
+                return (1 << i) / 1000000.0
+        return self.worst
+
+    def __str__(self):
+        if not self.count:
+            return "n=0"
+        return "n=%d avg=%s p50<%s p99<%s max=%s" % (
+            self.count,
+            format_seconds(self.total / self.count),
+            format_seconds(self.percentile(0.5)),
+            format_seconds(self.percentile(0.99)),
+            format_seconds(self.worst),
+        )
+
+
+def format_seconds(seconds):
+    if seconds < 0.001:
+        return "%dus" % (seconds * 1000000)
+    if seconds < 1:
+        return "%.1fms" % (seconds * 1000)
+    return "%.2fs" % seconds
+
+
+class DecoderStats(object):
+    """Counters and latency histograms of a monitor session.
+
+    Updated from both the rx and the decoder threads without a lock, the
+    numbers are meant for diagnostics only.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.counters = collections.Counter()
+        self.histograms = collections.defaultdict(LatencyHistogram)
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+    def timing(self, name, seconds):
+        self.histograms[name].add(seconds)
+
+    def get_line_time(self):
+        lines = self.counters["lines"]
+        return self.histograms["rx"].total / lines if lines else 0.0
+
+    def summary(self):
+        return (
+            "%d lines (%s/line), %d crashes (%d decodes skipped), "
+            "%d addresses looked up, %d skipped, %d bytes truncated, "
+            "%d parser resets"
+            % (
+                self.counters["lines"],
+                format_seconds(self.get_line_time()),
+                self.counters["crashes"],
+                self.counters["skipped decodes"],
+                self.counters["addresses"],
+                self.counters["skipped addresses"],
+                self.counters["truncated bytes"],
+                self.counters["parser resets"],
+            )
+        )
+
+    def report(self):
+        lines = ["session of %s" % format_seconds(time.time() - self.started)]
+        for name in sorted(self.counters):
+            lines.append("  %-22s %d" % (name, self.counters[name]))
+        lines.append(
+            "  %-22s %s" % ("time per line", format_seconds(self.get_line_time()))
+        )
+        for name in sorted(self.histograms):
+            lines.append("  %-22s %s" % (name + " latency", self.histograms[name]))
+        return "\n".join(lines)
+
+
+def find_rom_ld_script(includes):
+    """Looks for the ROM symbols shipped with the SDK next to its headers"""
+    if isinstance(includes, dict):
+        includes = [path for paths in includes.values() for path in paths]
+    for include_dir in includes or []:
+        path = os.path.join(include_dir, os.pardir, "ld", "eagle.rom.addr.v6.ld")
+        if os.path.isfile(path):
+            return os.path.normpath(path)
+    return None
+
+
+def find_bootloader(includes):
+    """eboot of the Arduino core, two levels above its core headers"""
+    if isinstance(includes, dict):
+        includes = [path for paths in includes.values() for path in paths]
+    for include_dir in includes or []:
+        path = os.path.join(
+            include_dir, os.pardir, os.pardir, "bootloaders", "eboot", "eboot.elf"
+        )
+        if os.path.isfile(path):
+            return os.path.normpath(path)
+    return None
+
+
+class CrashParser(object):
+    """Picks exceptions and stack dumps out of the serial output line by line.
+
+    `on_exception(crash_id, code, registers)` gets the register name/value
+    pairs of an exception and `on_stack(crash_id, words)` every word of a
+    stack dump. A stack dump printed right after an exception shares its
+    crash id. `on_crash_end(crash_id)`, if given, follows once nothing more
+    belongs to the crash.
+    """
 
     STATE_DEFAULT = 0
     STATE_IN_STACK = 1
 
     EXCEPTION_MARKER = "Exception ("
+    STACK_BEGIN = ">>>stack>>>"
+    STACK_END = "<<<stack<<<"
+
+    # a stack dump within this many lines belongs to the preceding exception
+    CRASH_LINES = 8
+    # the whole cont stack is 4 KB, that is 256 lines
+    MAX_STACK_LINES = 512
+
+    exception_re = re.compile(r"^([0-9]{1,2})\):\n([a-z0-9]+=0x[0-9a-f]{8} ?)+$")
+    stack_re = re.compile(r"^[0-9a-f]{8}:\s+([0-9a-f]{8} ?)+ *$")
+
+    def __init__(self, on_exception, on_stack, on_crash_end=None):
+        self.on_exception = on_exception
+        self.on_stack = on_stack
+        self.on_crash_end = on_crash_end
+        self.previous_line = ""
+        self.state = self.STATE_DEFAULT
+        self.no_match_counter = 0
+        self.stack_lines = 0
+        self.stack_words = []
+        self.line_count = 0
+        self.crash_id = 0
+        self.crash_line = None
+        # stack dumps given up on after too many lines that did not match
+        self.reset_count = 0
+
+    def feed(self, text):
+        """Parses complete lines, a trailing partial line must be held back"""
+        lines = text.split("\n")
+        if self.can_skip(text):
+            self.line_count += len(lines)
+            self.previous_line = lines[-1]
+            self.check_crash_end()
+            return
+        for line in lines:
+            if line and line[-1] == "\r":
+                line = line[:-1]
+            self.line_count += 1
+            self.process_line(line)
+            self.previous_line = line
+
+    def finish(self):
+        """Reports a stack dump cut off by the end of the log"""
+        if self.state == self.STATE_IN_STACK:
+            self.state = self.STATE_DEFAULT
+            self.take_stack()
+        if self.crash_line is not None:
+            self.end_crash()
+
+    def can_skip(self, text):
+        """Lines that can not start or continue a crash need no parsing"""
+        return (
+            self.state == self.STATE_DEFAULT
+            and not self.previous_line.startswith(self.EXCEPTION_MARKER)
+            and self.EXCEPTION_MARKER not in text
+            and self.STACK_BEGIN not in text
+        )
+
+    def advance_state(self):
+        self.state += 1
+        self.no_match_counter = 0
+
+    def start_crash(self):
+        if self.crash_line is not None:
+            self.end_crash()
+        self.crash_id += 1
+        self.crash_line = self.line_count
+
+    def end_crash(self):
+        self.crash_line = None
+        if self.on_crash_end is not None:
+            self.on_crash_end(self.crash_id)
+
+    def check_crash_end(self):
+        """An exception not followed by a stack dump ends after a few lines"""
+        if (
+            self.state == self.STATE_DEFAULT
+            and self.crash_line is not None
+            and self.line_count - self.crash_line > self.CRASH_LINES
+        ):
+            self.end_crash()
+
+    def process_line(self, line):
+        if self.state == self.STATE_DEFAULT:
+            self.check_crash_end()
+            if self.previous_line.startswith(self.EXCEPTION_MARKER):
+                two_lines = (
+                    self.previous_line[len(self.EXCEPTION_MARKER) :] + "\n" + line
+                )
+                match = self.exception_re.match(two_lines)
+                if match is not None:
+                    self.process_exception_match(match)
+
+            if line == self.STACK_BEGIN:
+                if (
+                    self.crash_line is None
+                    or self.line_count - self.crash_line > self.CRASH_LINES
+                ):
+                    self.start_crash()
+                self.advance_state()
+            return
+        elif self.state == self.STATE_IN_STACK:
+            if line == self.STACK_END:
+                self.state = self.STATE_DEFAULT
+                self.take_stack()
+                return
+
+            match = self.stack_re.match(line)
+            if match is not None:
+                self.process_stack_match(line)
+                return
+
+        self.no_match_counter += 1
+        if self.no_match_counter > 4:
+            self.reset_count += 1
+            self.state = self.STATE_DEFAULT
+            self.take_stack()
+            self.process_line(line)
+
+    def process_exception_match(self, match):
+        self.start_crash()
+        header = match.group(0)
+        registers = header[header.index("\n") + 1 :].split()
+        self.on_exception(
+            self.crash_id,
+            int(match.group(1)),
+            [tuple(reg.split("=", 1)) for reg in registers],
+        )
+
+    def process_stack_match(self, line):
+        if self.stack_lines < self.MAX_STACK_LINES:
+            self.stack_lines += 1
+            self.stack_words.extend(line[line.index(":") + 1 :].split())
+
+    def take_stack(self):
+        words = self.stack_words
+        self.stack_words = []
+        self.stack_lines = 0
+        if words:
+            self.on_stack(self.crash_id, words)
+        if self.crash_line is not None:
+            self.end_crash()
+
+
+class FirmwareResolver(object):  # pylint: disable=too-many-instance-attributes
+    """Resolves code addresses of one firmware to source lines.
+
+    Lookups go through the session cache, then the symbol index shared
+    with other sessions, then a long-lived addr2line process.
+    """
+
+    # https://github.com/esp8266/esp8266-wiki/wiki/Memory-Map
+    ADDR_MIN = 0x40000000
+    ADDR_MAX = 0x40300000
+    ROM_MIN = 0x40000000
+    ROM_MAX = 0x40010000
+
+    ADDRESS_CACHE_SIZE = 4096
+    # a lock older than this is left behind by a crashed monitor session
+    SYMBOL_INDEX_LOCK_TIMEOUT = 600
+
+    def __init__(  # pylint: disable=too-many-arguments
+        self,
+        firmware_path,
+        addr2line_path,
+        project_dir=None,
+        name=None,
+        rom_ld_script=None,
+        index_dir=None,
+    ):
+        self.firmware_path = firmware_path
+        # images of packages such as eboot.elf are not writable, the owner
+        # of the resolver passes a directory of the project
+        self.index_dir = index_dir or os.path.dirname(os.path.abspath(firmware_path))
+        self.addr2line_path = addr2line_path
+        self.project_dir = project_dir
+        self.name = name or self.__class__.__name__
+        self.rom_ld_script = rom_ld_script
+        # executable sections of the firmware, None if they are unknown
+        self.code_starts = None
+        self.code_ends = None
+        self.rom_addrs = []
+        self.rom_names = []
+        self.stats = None
+        self.addr2line = None
+        self.symbol_index = None
+        self.symbol_index_path = None
+        self.firmware_mtime = None
+        self.firmware_hash = None
+        self.address_cache = AddressCache(self.ADDRESS_CACHE_SIZE)
+
+    def close(self):
+        if self.addr2line is not None:
+            self.addr2line.close()
+            self.addr2line = None
+        if self.symbol_index is not None:
+            self.symbol_index.close()
+            self.symbol_index = None
+
+    def kill(self):
+        addr2line = self.addr2line
+        if addr2line is not None:
+            addr2line.kill()
+
+    def get_code_ranges(self):
+        """Address ranges is_addr_ok() accepts"""
+        if self.code_starts is None:
+            ranges = [(self.ADDR_MIN, self.ADDR_MAX)]
+        else:
+            ranges = list(zip(self.code_starts, self.code_ends))
+        if self.rom_addrs:
+            ranges.append((self.ROM_MIN, self.ROM_MAX))
+        return ranges
+
+    def open_firmware(self, background=True):
+        try:
+            elf = ElfFile(self.firmware_path)
+        except (OSError, ValueError, struct.error) as e:
+            sys.stderr.write("%s: symbol index is not available: %s\n" % (self.name, e))
+            return
+        self.load_code_layout(elf)
+        self.firmware_mtime = os.path.getmtime(self.firmware_path)
+        self.firmware_hash = hashlib.sha1(elf.data).hexdigest()
+        self.symbol_index_path = SymbolIndex.get_path(
+            self.index_dir, self.firmware_path, self.firmware_hash
+        )
+        if self.load_symbol_index():
+            return
+        if background:
+            # addr2line serves the lookups until the index is ready
+            threading.Thread(
+                target=self.build_symbol_index,
+                args=(elf, self.firmware_hash),
+                daemon=True,
+            ).start()
+        else:
+            self.build_symbol_index(elf, self.firmware_hash)
+
+    def load_code_layout(self, elf):
+        ranges = elf.get_code_ranges()
+        self.code_starts = [start for start, _ in ranges] or None
+        self.code_ends = [end for _, end in ranges] or None
+
+        # ROM functions the firmware links against are absolute symbols
+        rom = {}
+        for name, value, _, shndx in elf.iter_symbols():
+            if shndx == SHN_ABS and name and self.ROM_MIN <= value < self.ROM_MAX:
+                rom.setdefault(value, name)
+        if self.rom_ld_script:
+            rom_re = re.compile(r"PROVIDE\s*\(\s*(\w+)\s*=\s*(0x[\da-f]+)\s*\)", re.I)
+            try:
+                with open(self.rom_ld_script) as fp:
+                    for match in rom_re.finditer(fp.read()):
+                        rom.setdefault(int(match.group(2), 16), match.group(1))
+            except OSError:
+                pass
+        self.rom_addrs = sorted(rom)
+        self.rom_names = [rom[addr] for addr in self.rom_addrs]
+
+    def lookup_rom(self, addr):
+        i = bisect.bisect_right(self.rom_addrs, addr) - 1
+        if i < 0:
+            return None
+        return "%s+0x%x (ROM)" % (self.rom_names[i], addr - self.rom_addrs[i])
+
+    def load_symbol_index(self):
+        if not os.path.isfile(self.symbol_index_path):
+            return False
+        try:
+            self.symbol_index = SymbolIndex(self.symbol_index_path)
+        except (OSError, ValueError, struct.error):
+            return False
+        return True
+
+    def build_symbol_index(self, elf, firmware_hash):
+        """Builds the index of the firmware with `firmware_hash`, the firmware
+        may be rebuilt and reopened while it runs in the background"""
+        index_path = SymbolIndex.get_path(
+            self.index_dir, self.firmware_path, firmware_hash
+        )
+        lock_path = index_path + ".lock"
+        try:
+            if not os.path.isdir(self.index_dir):
+                os.makedirs(self.index_dir, exist_ok=True)
+            if (
+                os.path.isfile(lock_path)
+                and time.time() - os.path.getmtime(lock_path)
+                > self.SYMBOL_INDEX_LOCK_TIMEOUT
+            ):
+                os.remove(lock_path)
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except OSError:
+            # another session is building it, get_lines() picks it up later
+            return
+
+        addr2line = Addr2Line(self.addr2line_path, self.firmware_path)
+        try:
+            SymbolIndex.build(index_path, elf, addr2line)
+            with open(self.firmware_path, "rb") as fp:
+                if hashlib.sha1(fp.read()).hexdigest() != firmware_hash:
+                    # addr2line read a newer build, the index is of neither
+                    os.remove(index_path)
+                    return
+            if firmware_hash == self.firmware_hash:
+                self.load_symbol_index()
+        except (OSError, ValueError, struct.error, IndexError) as e:
+            sys.stderr.write("%s: failed to build symbol index: %s\n" % (self.name, e))
+        finally:
+            addr2line.close()
+            os.close(fd)
+            os.remove(lock_path)
+
+    def check_firmware(self):
+        """Forgets everything decoded so far once the firmware is rebuilt"""
+        try:
+            mtime = os.path.getmtime(self.firmware_path)
+            if mtime == self.firmware_mtime:
+                return
+            with open(self.firmware_path, "rb") as fp:
+                firmware_hash = hashlib.sha1(fp.read()).hexdigest()
+        except OSError:
+            return
+        if firmware_hash == self.firmware_hash:
+            self.firmware_mtime = mtime
+            return
+
+        self.address_cache.clear()
+        self.close()
+        self.open_firmware()
+
+    def is_addr_ok(self, hex_addr):
+        try:
+            addr = int(hex_addr, 16)
+        except ValueError:
+            return False
+        if addr < self.ADDR_MIN or addr >= self.ADDR_MAX:
+            return False
+        if self.ROM_MIN <= addr < self.ROM_MAX:
+            return bool(self.rom_addrs)
+        if self.code_starts is None:
+            return True
+        # data and stale return addresses outside of the code sections
+        i = bisect.bisect_right(self.code_starts, addr) - 1
+        return i >= 0 and addr < self.code_ends[i]
+
+    def get_lines(self, addresses):
+        result = [None] * len(addresses)
+        wanted = [i for i, addr in enumerate(addresses) if self.is_addr_ok(addr)]
+        if not wanted:
+            return result
+
+        self.check_firmware()
+        if self.symbol_index is None and self.symbol_index_path:
+            self.load_symbol_index()
+
+        started = time.perf_counter()
+        pending = []
+        for i in wanted:
+            addr = int(addresses[i], 16)
+            try:
+                result[i] = self.address_cache[addr]
+                continue
+            except KeyError:
+                pass
+            output = None
+            if self.ROM_MIN <= addr < self.ROM_MAX:
+                output = self.lookup_rom(addr)
+            elif self.symbol_index is not None:
+                output = self.symbol_index.lookup(addr)
+            if output is None:
+                pending.append(i)
+            else:
+                result[i] = self.strip_project_dir(output)
+                self.address_cache[addr] = result[i]
+        if self.stats is not None:
+            self.stats.count("addresses", len(wanted))
+            self.stats.timing("symbol lookup", time.perf_counter() - started)
+        wanted = pending
+        if not wanted:
+            return result
+
+        if self.addr2line is None:
+            self.addr2line = Addr2Line(self.addr2line_path, self.firmware_path)
+
+        started = time.perf_counter()
+        try:
+            outputs = self.addr2line.lookup([addresses[i] for i in wanted])
+        except (OSError, ValueError) as e:
+            sys.stderr.write(
+                "%s: failed to call %s: %s\n" % (self.name, self.addr2line_path, e)
+            )
+            return result
+        if self.stats is not None:
+            self.stats.count("addr2line addresses", len(wanted))
+            self.stats.timing("addr2line", time.perf_counter() - started)
+
+        for i, output in zip(wanted, outputs):
+            if output != "?? ??:0":
+                result[i] = self.strip_project_dir(output)
+            self.address_cache[int(addresses[i], 16)] = result[i]
+        return result
+
+    def strip_project_dir(self, trace):
+        if not self.project_dir:
+            return trace
+        while True:
+            idx = trace.find(self.project_dir)
+            if idx == -1:
+                break
+            trace = trace[:idx] + trace[idx + len(self.project_dir) + 1 :]
+        return trace
+
+
+class ImageSet(object):
+    """Resolves addresses against several firmware images at once.
+
+    The code ranges of all images are merged into one interval index that
+    maps an address to the images covering it, in the order the images were
+    given. Images overlap when an older build of the application still runs
+    in the other OTA slot, then the next image is asked for addresses the
+    previous one could not resolve.
+    """
+
+    def __init__(self, resolvers):
+        self.resolvers = resolvers
+        self.labels = [os.path.basename(r.firmware_path) for r in resolvers]
+        # (starts, ends, images), replaced as a whole so the rx thread never
+        # sees an index that is half rebuilt
+        self._index = ((), (), ())
+        self.index_hashes = None
+
+    @property
+    def stats(self):
+        return self.resolvers[0].stats
+
+    @stats.setter
+    def stats(self, stats):
+        for resolver in self.resolvers:
+            resolver.stats = stats
+
+    def open_firmware(self, background=True):
+        for resolver in self.resolvers:
+            resolver.open_firmware(background)
+        self.build_index()
+
+    def close(self):
+        for resolver in self.resolvers:
+            resolver.close()
+
+    def kill(self):
+        for resolver in self.resolvers:
+            resolver.kill()
+
+    def build_index(self):
+        ranges = [
+            (start, end, i)
+            for i, resolver in enumerate(self.resolvers)
+            for start, end in resolver.get_code_ranges()
+        ]
+        bounds = sorted(set(addr for start, end, _ in ranges for addr in (start, end)))
+        starts = []
+        ends = []
+        images_list = []
+        for start, end in zip(bounds, bounds[1:]):
+            images = tuple(sorted(i for s, e, i in ranges if s <= start and end <= e))
+            if not images:
+                continue
+            if images_list and ends[-1] == start and images_list[-1] == images:
+                ends[-1] = end
+                continue
+            starts.append(start)
+            ends.append(end)
+            images_list.append(images)
+        self._index = (starts, ends, images_list)
+        self.index_hashes = [r.firmware_hash for r in self.resolvers]
+
+    def get_images(self, hex_addr):
+        try:
+            addr = int(hex_addr, 16)
+        except ValueError:
+            return ()
+        starts, ends, images = self._index
+        i = bisect.bisect_right(starts, addr) - 1
+        if i < 0 or addr >= ends[i]:
+            return ()
+        return images[i]
+
+    def is_addr_ok(self, hex_addr):
+        return bool(self.get_images(hex_addr))
+
+    def get_lines(self, addresses):
+        for resolver in self.resolvers:
+            resolver.check_firmware()
+        if [r.firmware_hash for r in self.resolvers] != self.index_hashes:
+            self.build_index()
+
+        result = [None] * len(addresses)
+        pending = [(i, self.get_images(addr)) for i, addr in enumerate(addresses)]
+        pending = [(i, images) for i, images in pending if images]
+        level = 0
+        while pending:
+            groups = collections.defaultdict(list)
+            for i, images in pending:
+                groups[images[level]].append(i)
+            for image, indexes in groups.items():
+                lines = self.resolvers[image].get_lines([addresses[i] for i in indexes])
+                for i, line in zip(indexes, lines):
+                    if line is not None and image:
+                        line = "%s (%s)" % (line, self.labels[image])
+                    result[i] = line
+            level += 1
+            pending = [
+                (i, images)
+                for i, images in pending
+                if result[i] is None and level < len(images)
+            ]
+        return result
+
+
+class Esp8266ExceptionDecoder(
+    DeviceMonitorFilterBase
+):  # pylint: disable=too-many-instance-attributes
+    NAME = "esp8266_exception_decoder"
+
+    # crashes waiting for the decoder thread, newer ones are skipped
+    DECODE_QUEUE_SIZE = 16
+    # seconds, overridden by `custom_exception_decoder_timeout`
+    DECODE_TIMEOUT = 5.0
+    # stack frames decoded per crash
+    MAX_STACK_FRAMES = 128
+    # partial line kept until its end arrives, the rest is dropped
+    MAX_LINE_BUFFER = 4096
+
+    # set to a non-empty value to collect performance counters
+    STATS_ENV_VAR = "ESP8266_EXCEPTION_DECODER_STATS"
+    # seconds between summary lines, overridden by
+    # `custom_exception_decoder_stats_interval`
+    STATS_INTERVAL = 60.0
 
     # https://github.com/me-no-dev/EspExceptionDecoder/blob/a78672da204151cc93979a96ed9f89139a73893f/src/EspExceptionDecoder.java#L59
     EXCEPTION_CODES = (
@@ -86,20 +1205,39 @@ class Esp8266ExceptionDecoder(
     )
 
     def __call__(self):
-        self.buffer = ""
-        self.previous_line = ""
-        self.state = self.STATE_DEFAULT
-        self.no_match_counter = 0
-        self.stack_lines = []
-
-        self.exception_re = re.compile(
-            r"^([0-9]{1,2})\):\n([a-z0-9]+=0x[0-9a-f]{8} ?)+$"
+        self.setup_decoder()
+        self.decode_timeout = float(
+            self.get_option("timeout", self.DECODE_TIMEOUT)
         )
-        self.stack_re = re.compile(r"^[0-9a-f]{8}:\s+([0-9a-f]{8} ?)+ *$")
 
         self.firmware_path = None
         self.addr2line_path = None
+        self.rom_ld_script = None
+        self.bootloader_path = None
+        self.index_dir = None
         self.enabled = self.setup_paths()
+        if self.enabled:
+            resolvers = [
+                FirmwareResolver(
+                    path,
+                    self.addr2line_path,
+                    self.project_dir,
+                    self.__class__.__name__,
+                    self.rom_ld_script if path == self.firmware_path else None,
+                    self.index_dir,
+                )
+                for path in self.get_image_paths()
+            ]
+            self.resolver = ImageSet(resolvers)
+            self.resolver.open_firmware()
+            threading.Thread(target=self.decode_worker, daemon=True).start()
+            atexit.register(self.print_crash_summary)
+            # runs before the summary, atexit calls in reverse order
+            atexit.register(self.flush_decoded)
+            if os.getenv(self.STATS_ENV_VAR):
+                self.setup_stats(
+                    float(self.get_option("stats_interval", self.STATS_INTERVAL))
+                )
 
         if self.config.get("env:" + self.environment, "build_type") != "debug":
             print(
@@ -112,11 +1250,63 @@ See https://docs.platformio.org/page/projectconf/build_configurations.html
 
         return self
 
+    def setup_decoder(self):
+        self.buffer = ""
+        self.parser = CrashParser(
+            self.exception_found, self.stack_found, self.crash_ended
+        )
+        self.resolver = None
+        self.decode_timeout = self.DECODE_TIMEOUT
+        self.decode_queue = queue.Queue(self.DECODE_QUEUE_SIZE)
+        self.decode_started = None
+        self.decoded = collections.deque()
+        # parts of the crashes still being parsed, by crash id
+        self.crash_parts = {}
+        # fingerprint -> CrashRecord, in the order of the first occurrence
+        self.crashes = collections.OrderedDict()
+        self.crash_count = 0
+        # decode jobs dropped while the queue was full
+        self.skipped_count = 0
+        self.stats = None
+        self.stats_interval = self.STATS_INTERVAL
+        self.stats_printed = None
+
+    def setup_stats(self, interval):
+        self.stats = DecoderStats()
+        self.stats_interval = interval
+        self.stats_printed = time.time()
+        self.resolver.stats = self.stats
+        atexit.register(self.print_stats)
+
+    def print_stats(self):
+        self.update_stats()
+        sys.stderr.write("%s: %s\n" % (self.__class__.__name__, self.stats.report()))
+        for label, resolver in zip(self.resolver.labels, self.resolver.resolvers):
+            sys.stderr.write(
+                "  %-22s %s\n" % (label + " cache", resolver.address_cache.info())
+            )
+
+    def update_stats(self):
+        """Takes over the counters the parser keeps itself"""
+        self.stats.counters["parser resets"] = self.parser.reset_count
+        self.stats.counters["lines"] = self.parser.line_count
+        self.stats.counters["crashes"] = self.crash_count
+        self.stats.counters["skipped decodes"] = self.skipped_count
+
+    def get_option(self, name, default=None):
+        return self.config.get(
+            "env:" + self.environment, "custom_exception_decoder_" + name, default
+        )
+
     def setup_paths(self):
         self.project_dir = os.path.abspath(self.project_dir)
         try:
             data = load_build_metadata(self.project_dir, self.environment)
             self.firmware_path = data["prog_path"]
+            # the build directory, shared by the indexes of all images
+            self.index_dir = os.path.join(
+                os.path.dirname(self.firmware_path), "symbol_index"
+            )
             if not os.path.isfile(self.firmware_path):
                 sys.stderr.write(
                     "%s: firmware at %s does not exist, rebuild the project?\n"
@@ -124,6 +1314,8 @@ See https://docs.platformio.org/page/projectconf/build_configurations.html
                 )
                 return False
 
+            self.rom_ld_script = find_rom_ld_script(data.get("includes"))
+            self.bootloader_path = find_bootloader(data.get("includes"))
             cc_path = data.get("cc_path", "")
             if "-gcc" in cc_path:
                 path = cc_path.replace("-gcc", "-addr2line")
@@ -141,150 +1333,222 @@ See https://docs.platformio.org/page/projectconf/build_configurations.html
         )
         return False
 
+    def get_image_paths(self):
+        """The application first, then eboot and `custom_exception_decoder_images`"""
+        paths = [self.firmware_path]
+        if self.bootloader_path:
+            paths.append(self.bootloader_path)
+        value = self.get_option("images", "")
+        if not isinstance(value, list):
+            value = re.split(r"[\n,]", value)
+        for path in value:
+            path = path.strip()
+            if not path:
+                continue
+            path = os.path.join(self.project_dir, os.path.expanduser(path))
+            if not os.path.isfile(path):
+                sys.stderr.write(
+                    "%s: image %s does not exist, skipping\n"
+                    % (self.__class__.__name__, path)
+                )
+            elif path not in paths:
+                paths.append(path)
+        return paths
+
     def rx(self, text):
         if not self.enabled:
             return text
 
-        last = 0
-        while True:
-            idx = text.find("\n", last)
-            if idx == -1:
-                if len(self.buffer) < 4096:
-                    self.buffer += text[last:]
-                break
-
-            line = text[last:idx]
-            if self.buffer:
-                line = self.buffer + line
-                self.buffer = ""
-            last = idx + 1
-
-            if line and line[-1] == "\r":
-                line = line[:-1]
-
-            extra = self.process_line(line)
-            self.previous_line = line
-            if extra is not None:
-                text = text[: idx + 1] + extra + text[idx + 1 :]
-                last += len(extra)
-        return text
-
-    def advance_state(self):
-        self.state += 1
-        self.no_match_counter = 0
-
-    def is_addr_ok(self, hex_addr):
-        try:
-            addr = int(hex_addr, 16)
-            return addr >= self.ADDR_MIN and addr < self.ADDR_MAX
-        except ValueError:
-            return False
+        if self.stats is not None:
+            started = time.perf_counter()
 
-    def process_line(self, line):  # pylint: disable=too-many-return-statements
-        if self.state == self.STATE_DEFAULT:
-            extra = None
-            if self.previous_line.startswith(self.EXCEPTION_MARKER):
-                two_lines = (
-                    self.previous_line[len(self.EXCEPTION_MARKER) :] + "\n" + line
-                )
-                match = self.exception_re.match(two_lines)
-                if match is not None:
-                    extra = self.process_exception_match(match)
+        line_start = not self.buffer
+        if "\n" not in text:
+            if len(self.buffer) < self.MAX_LINE_BUFFER:
+                self.buffer += text
+            elif self.stats is not None:
+                self.stats.count("truncations")
+                self.stats.count("truncated bytes", len(text))
+        else:
+            # one split per chunk keeps framing linear in the chunk size
+            chunk = self.buffer + text
+            idx = chunk.rfind("\n")
+            self.buffer = chunk[idx + 1 :]
+            self.parser.feed(chunk[:idx])
 
-            if line == ">>>stack>>>":
-                self.advance_state()
-            return extra
-        elif self.state == self.STATE_IN_STACK:
-            if line == "<<<stack<<<":
-                self.state = self.STATE_DEFAULT
-                return self.take_stack_lines()
+        if self.stats is not None:
+            self.stats.timing("rx", time.perf_counter() - started)
+            self.check_stats_interval()
+        return self.insert_decoded(text, line_start)
 
-            match = self.stack_re.match(line)
-            if match is not None:
-                self.process_stack_match(line)
-                return None
+    def check_stats_interval(self):
+        now = time.time()
+        if now - self.stats_printed < self.stats_interval:
+            return
+        self.stats_printed = now
+        self.update_stats()
+        self.decoded.append("\n--- decoder stats: %s ---\n\n" % self.stats.summary())
 
-        self.no_match_counter += 1
-        if self.no_match_counter > 4:
-            self.state = self.STATE_DEFAULT
-            results = [self.take_stack_lines(), self.process_line(line)]
-            results = [r for r in results if r is not None]
-            if results:
-                return "\n".join(results)
-        return None
+    def insert_decoded(self, text, line_start):
+        """Places decoded crashes after the last complete line of `text`"""
+        if not self.decoded:
+            return text
+        idx = text.rfind("\n")
+        if idx == -1 and not line_start:
+            return text
+        return text[: idx + 1] + self.take_decoded() + text[idx + 1 :]
 
-    def process_exception_match(self, match):
-        extra = "\n"
-        try:
-            code = int(match.group(1))
-            if code >= 0 and code < len(self.EXCEPTION_CODES):
-                extra += "%s\n" % self.EXCEPTION_CODES[code]
-        except ValueError:
-            pass
+    def take_decoded(self):
+        blocks = []
+        while self.decoded:
+            blocks.append(self.decoded.popleft())
+        return "".join(blocks)
 
-        header = match.group(0)
-        registers = header[header.index("\n") + 1 :].split()
-        pairs = [reg.split("=", 2) for reg in registers]
+    def flush_decoded(self):
+        """Prints the crashes decoded after the last rx(), the device may
+        have gone quiet after the crash"""
+        text = self.take_decoded()
+        if text:
+            sys.stdout.write(text)
+            sys.stdout.flush()
 
-        lines = self.get_lines([p[1] for p in pairs])
+    def exception_found(self, crash_id, code, registers):
+        self.crash_parts.setdefault(crash_id, []).append(
+            ("Exception (%d)" % code, self.decode_exception, (code, registers))
+        )
 
-        for i, p in enumerate(pairs):
-            if lines[i] is not None:
-                l = lines[i].replace(
-                    "\n", "\n    "
-                )  # newlines happen with inlined methods
-                extra += "  %s=%s in %s\n" % (p[0], p[1], l)
-        return extra
+    def stack_found(self, crash_id, words):
+        addresses = [w for w in words if self.resolver.is_addr_ok(w)]
+        if self.stats is not None:
+            self.stats.count("stack words", len(words))
+            self.stats.count("skipped addresses", len(words) - len(addresses))
+            self.stats.count(
+                "dropped frames", max(0, len(addresses) - self.MAX_STACK_FRAMES)
+            )
+        if addresses:
+            self.crash_parts.setdefault(crash_id, []).append(
+                ("stack", self.decode_stack, (addresses[: self.MAX_STACK_FRAMES],))
+            )
 
-    def process_stack_match(self, line):
-        if len(self.stack_lines) > 128:
+    def crash_ended(self, crash_id):
+        parts = self.crash_parts.pop(crash_id, None)
+        if not parts:
             return
+        self.crash_count += 1
+        fingerprint, pc = self.get_fingerprint(parts)
+        record = self.crashes.get(fingerprint)
+        if record is not None:
+            # a crash loop, the backtrace is the one decoded already
+            if self.stats is not None:
+                self.stats.count("repeated crashes")
+            record = record._replace(count=record.count + 1)
+            self.crashes[fingerprint] = record
+            self.decoded.append(
+                "\n--- crash #%d seen x%d ---\n\n" % (record.crash_id, record.count)
+            )
+            return
+        self.crashes[fingerprint] = CrashRecord(crash_id, parts[0][0], pc, 1)
+        for title, func, args in parts:
+            self.submit(crash_id, title, func, *args)
 
-        addresses = line[line.index(":") + 1 :].split()
-        lines = self.get_lines(addresses)
-        for i, l in enumerate(lines):
-            if l is not None:
-                self.stack_lines.append("0x%s in %s" % (addresses[i], l))
+    @staticmethod
+    def get_fingerprint(parts):
+        """The exception code, the PC and the code addresses of the stack.
 
-    def take_stack_lines(self):
-        if self.stack_lines:
-            res = "\n%s\n\n" % "\n".join(self.stack_lines)
-            self.stack_lines = []
-            return res
-        return None
+        Addresses stand for the decoded frames, so repeats are found
+        without decoding them.
+        """
+        key = []
+        pc = None
+        for title, _, args in parts:
+            if title == "stack":
+                key.extend(args[0])
+            else:
+                registers = dict(args[1])
+                pc = registers.get("epc1")
+                key.extend((title, pc))
+        fingerprint = hashlib.sha1(" ".join(key).encode()).hexdigest()[:8]
+        return fingerprint, pc
 
-    def get_lines(self, addresses):
-        result = []
+    def print_crash_summary(self):
+        if not self.crashes:
+            return
+        lines = [
+            "",
+            "%s: %d crashes, %d unique, %d decodes skipped while busy"
+            % (
+                self.__class__.__name__,
+                self.crash_count,
+                len(self.crashes),
+                self.skipped_count,
+            ),
+            "%8s %7s  %-8s  %s" % ("crash", "seen", "id", "exception"),
+        ]
+        for fingerprint, record in self.crashes.items():
+            title = record.title
+            if record.pc is not None:
+                title += " at %s" % record.pc
+            lines.append(
+                "%8s %7d  %s  %s"
+                % ("#%d" % record.crash_id, record.count, fingerprint, title)
+            )
+        print("\n".join(lines))
 
-        enc = "mbcs" if IS_WINDOWS else "utf-8"
-        args = [self.addr2line_path, u"-fipC", u"-e", self.firmware_path]
+    def submit(self, crash_id, title, func, *args):
+        try:
+            self.decode_queue.put_nowait((crash_id, title, func, args))
+        except queue.Full:
+            self.skipped_count += 1
+            self.decoded.append(
+                "\n--- crash #%d (%s): decoder is busy, skipped ---\n\n"
+                % (crash_id, title)
+            )
 
-        for addr in addresses:
-            if not self.is_addr_ok(addr):
-                result.append(None)
+    def decode_worker(self):
+        while True:
+            crash_id, title, func, args = self.decode_queue.get()
+            self.decode_started = time.time()
+            # a hung addr2line is killed even when no more data arrives, the
+            # lookup returns whatever was resolved until then
+            timer = threading.Timer(self.decode_timeout, self.resolver.kill)
+            timer.daemon = True
+            timer.start()
+            try:
+                extra = func(*args)
+            finally:
+                timer.cancel()
+            elapsed = time.time() - self.decode_started
+            self.decode_started = None
+            if self.stats is not None:
+                self.stats.timing("decode", elapsed)
+            note = ""
+            if elapsed > self.decode_timeout:
+                note = ", timed out after %.1fs" % elapsed
+            elif not extra:
                 continue
+            self.decoded.append(
+                "\n--- decoded crash #%d (%s%s) ---\n%s\n\n"
+                % (crash_id, title, note, (extra or "").strip("\n"))
+            )
 
-            to_append = None
-            try:
-                output = (
-                    subprocess.check_output(args + [addr])
-                    .decode(enc)
-                    .strip()
-                )
-                if output != "?? ??:0":
-                    to_append = self.strip_project_dir(output)
-            except subprocess.CalledProcessError as e:
-                sys.stderr.write(
-                    "%s: failed to call %s: %s\n"
-                    % (self.__class__.__name__, self.addr2line_path, e)
-                )
-            result.append(to_append)
-        return result
+    def decode_exception(self, code, registers):
+        extra = "\n"
+        if code >= 0 and code < len(self.EXCEPTION_CODES):
+            extra += "%s\n" % self.EXCEPTION_CODES[code]
 
-    def strip_project_dir(self, trace):
-        while True:
-            idx = trace.find(self.project_dir)
-            if idx == -1:
-                break
-            trace = trace[:idx] + trace[idx + len(self.project_dir) + 1 :]
-        return trace
+        lines = self.resolver.get_lines([value for _, value in registers])
+        for (name, value), l in zip(registers, lines):
+            if l is not None:
+                l = l.replace("\n", "\n    ")  # newlines happen with inlined methods
+                extra += "  %s=%s in %s\n" % (name, value, l)
+        return extra
+
+    def decode_stack(self, addresses):
+        stack_lines = [
+            "0x%s in %s" % (addr, l)
+            for addr, l in zip(addresses, self.resolver.get_lines(addresses))
+            if l is not None
+        ]
+        if stack_lines:
+            return "\n%s\n\n" % "\n".join(stack_lines)
+        return None
@@ -21,9 +21,11 @@ class Espressif8266Platform(PlatformBase):
         framework = variables.get("pioframework", [])
         if "arduino" not in framework:
             self.packages['toolchain-xtensa']['version'] = "~1.40802.0"
-        if "buildfs" in targets:
+        if set(["buildfs", "flashall"]) & set(targets):
             self.packages['tool-mkspiffs']['optional'] = False
-            self.packages['tool-mklittlefs']['optional'] = False
+            # LittleFS images may be built in-process instead
+            if variables.get("board_build.fs_builder", "tool") != "python":
+                self.packages['tool-mklittlefs']['optional'] = False
         return super().configure_default_packages(variables, targets)
 
     def get_boards(self, id_=None):